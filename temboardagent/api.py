@@ -20,6 +20,8 @@ from temboardagent.usermgmt import auth_user, gen_sessionid
 from temboardagent.spc import connector, error
 from temboardagent.notification import NotificationMgmt, Notification
 from temboardagent.inventory import SysInfo, PgInfo
+from temboardagent.postgres import query_stats
+from temboardagent.utils import JSONArray
 
 
 logger = logging.getLogger(__name__)
@@ -118,7 +120,8 @@ def get_discover(http_context, config=None, sessions=None):
         port=config.postgresql['port'],
         user=config.postgresql['user'],
         password=config.postgresql['password'],
-        database=config.postgresql['dbname']
+        database=config.postgresql['dbname'],
+        connect_timeout=config.postgresql['connect_timeout']
     )
     logger.info('Starting discovery.')
     try:
@@ -185,10 +188,28 @@ def notifications(http_context, config=None, sessions=None):
         raise e
 
     try:
-        notifications = NotificationMgmt.get_last_n(config, -1)
+        notifications = NotificationMgmt.get_last_n(config, -1, raw=True)
         logger.info("Done.")
-        return list(notifications)
+        return JSONArray(notifications)
     except (NotificationError, Exception) as e:
         logger.exception(e.message)
         logger.info("Failed.")
         raise HTTPError(500, "Internal error.")
+
+
+@add_route('GET', '/statistics/queries')
+def query_statistics(http_context, config=None, sessions=None):
+    headers = http_context['headers']
+    logger.info("Get query statistics.")
+    try:
+        check_sessionid(headers, sessions)
+    except HTTPError as e:
+        logger.exception(e.message)
+        logger.info("Invalid session.")
+        raise e
+
+    # Statistics are kept per process: only SQL run by the HTTP server
+    # process is reported, not the one of scheduler workers like monitoring
+    # probes.
+    logger.info("Done.")
+    return query_stats.report()
@@ -2,7 +2,7 @@ import logging
 
 from temboardagent.api import check_sessionid
 from temboardagent.errors import HTTPError
-from temboardagent.spc import connector, error
+from temboardagent.spc import error
 
 
 logger = logging.getLogger(__name__)
@@ -14,10 +14,10 @@ def api_function_wrapper_pg(config, http_context, sessions, module,
     API function wrapper in charge of:
         - instanciating a new logger;
         - check the user session id;
-        - start a new PostgreSQL connection;
+        - borrow a PostgreSQL connection from the pool;
         - call the function 'function_name' from 'module_name' module and
           return its result;
-        - close PG connection.
+        - give PG connection back to the pool.
     """
     logger.debug("Calling %s.%s()." % (module.__name__, function_name,))
     logger.debug(http_context)
@@ -25,26 +25,15 @@ def api_function_wrapper_pg(config, http_context, sessions, module,
     try:
         username = check_sessionid(http_context['headers'], sessions)
         http_context['username'] = username
-        conn = connector(
-            host=config.postgresql['host'],
-            port=config.postgresql['port'],
-            user=config.postgresql['user'],
-            password=config.postgresql['password'],
-            database=config.postgresql['dbname']
-        )
-        conn.connect()
-        dm = getattr(module, function_name)(conn, config, http_context)
-        conn.close()
+        subsystem = '%s.%s' % (module.__name__, function_name)
+        with http_context['postgres'].connect(subsystem) as conn:
+            dm = getattr(module, function_name)(conn, config, http_context)
         logger.debug("Done.")
         return dm
 
     except (error, Exception, HTTPError) as e:
         logger.exception(str(e))
         logger.debug("Failed.")
-        try:
-            conn.close()
-        except Exception:
-            pass
         if isinstance(e, HTTPError):
             raise e
         else:
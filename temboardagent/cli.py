@@ -101,6 +101,9 @@ class Application(object):
         # new configuration.
 
         self.setup_logging()
+        if getattr(self, 'postgres', None):
+            # Drop idle connections opened with the previous configuration.
+            self.postgres.close()
         self.postgres = Postgres(**self.config.postgresql)
 
         if not self.with_plugins:
@@ -160,6 +163,8 @@ class Application(object):
         yield OptionSpec(s, 'user', default='postgres')
         yield OptionSpec(s, 'password')
         yield OptionSpec(s, 'dbname', default='postgres')
+        yield OptionSpec(
+            s, 'connect_timeout', default=10, validator=v.timeout)
 
     def read_file(self, parser, filename):
         logger.info('Reading %s.', filename)
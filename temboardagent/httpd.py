@@ -18,6 +18,7 @@ from temboardagent.errors import HTTPError
 from temboardagent import __version__ as temboard_version
 from .sharedmemory import Sessions
 from .services import Service
+from .utils import JSONArray
 
 
 logger = logging.getLogger(__name__)
@@ -31,7 +32,7 @@ class RequestHandler(BaseHTTPRequestHandler):
     """
     HTTP request handler.
     """
-    def __init__(self, config, sessions, *args, **kwargs):
+    def __init__(self, config, sessions, postgres, *args, **kwargs):
         """
         Constructor.
         """
@@ -39,6 +40,8 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.sessions = sessions
         # Configuration instance.
         self.config = config
+        # Postgres instance, owning the connection pool.
+        self.postgres = postgres
         # HTTP server version.
         self.server_version = "temboard-agent/%s" % temboard_version
         # HTTP request method
@@ -117,7 +120,10 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Content-type', 'application/json')
         self.end_headers()
-        self.wfile.write(json.dumps(message).encode('utf-8'))
+        if isinstance(message, JSONArray):
+            self.wfile.write(message.dumps())
+        else:
+            self.wfile.write(json.dumps(message).encode('utf-8'))
 
     def route_request(self,):
         """
@@ -178,7 +184,8 @@ class RequestHandler(BaseHTTPRequestHandler):
                         'headers': self.headers,
                         'query': self.query,
                         'post': self.post_json,
-                        'urlvars': urlvars
+                        'urlvars': urlvars,
+                        'postgres': self.postgres,
                     }
                     # Call the right API function.
                     response = getattr(sys.modules[route['module']],
@@ -210,4 +217,5 @@ class HTTPDService(Service):
         self.sessions.purge_expired(3600, logger, self.app.config)
 
     def handle_request(self, *args):
-        return RequestHandler(self.app.config, self.sessions, *args)
+        return RequestHandler(
+            self.app.config, self.sessions, self.app.postgres, *args)
@@ -286,9 +286,10 @@ class PgInfo(Inventory):
         q = "SELECT version(), setting AS server FROM pg_settings WHERE " \
             "name = 'server_version'"
         self.db_conn.execute(q)
+        row = list(self.db_conn.get_rows())[0]
         return {
-            'full': list(self.db_conn.get_rows())[0]['version'],
-            'server': list(self.db_conn.get_rows())[0]['server'],
+            'full': row['version'],
+            'server': row['server'],
             'num': self.db_conn.get_pg_version()
         }
 
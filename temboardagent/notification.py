@@ -2,6 +2,7 @@ from temboardagent.queue import Queue, Message
 from temboardagent.errors import NotificationError
 import json
 import datetime
+import logging
 
 """
 Notifications are messages stored in a Queue aimed to keep a track of each
@@ -15,6 +16,8 @@ For now, they are pushed when one of the following actions is triggered:
 Queue max size is set to 10MB, LIFO behaviour is expected.
 """
 
+logger = logging.getLogger(__name__)
+
 
 class Notification(object):
 
@@ -39,22 +42,25 @@ class NotificationMgmt():
                       overflow_mode='slide')
 
             # Push the notification in the queue.
-            q.push(Message(content=json.dumps({
+            evicted = q.push(Message(content=json.dumps({
                                         'date': notification.date,
                                         'username': notification.username,
                                         'message': notification.message})))
+            if evicted:
+                logger.warning("Notifications queue is full, %s oldest "
+                               "notification(s) removed." % (evicted,))
         except (Exception) as e:
             raise NotificationError('Can not push new notification: %s' %
                                     e.message)
 
     @classmethod
-    def get_last_n(self, config, n):
+    def get_last_n(self, config, n, raw=False):
         try:
             q_last = Queue(file_path='%s/notifications.q' % (
                                      config.temboard['home']),
                            max_length=10 * 1024 * 1024,
                            overflow_mode='slide')
-            return q_last.get_last_n_messages(n)
+            return q_last.get_last_n_messages(n, raw=raw)
         except (Exception) as e:
             raise NotificationError('Can not get last notifications: %s' %
                                     e.message)
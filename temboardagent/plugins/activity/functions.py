@@ -76,20 +76,19 @@ ORDER BY
   EXTRACT(epoch FROM (NOW() - pg_stat_activity.query_start)) DESC
         """
 
-    conn.execute(query)
     backend_list = []
-    for row in conn.get_rows():
+    for row in conn.execute_iter(query, row_factory='namedtuple'):
         try:
             backend_list.append({
-                'pid': row['pid'],
-                'database': row['database'],
-                'client': row['client'],
-                'duration': row['duration'],
-                'wait': row['wait'],
-                'user': row['user'],
-                'state': row['state'],
-                'query': row['query'],
-                'process': Process(row['pid'], mem_total, page_size)})
+                'pid': row.pid,
+                'database': row.database,
+                'client': row.client,
+                'duration': row.duration,
+                'wait': row.wait,
+                'user': row.user,
+                'state': row.state,
+                'query': row.query,
+                'process': Process(row.pid, mem_total, page_size)})
         except Exception:
             pass
 
@@ -130,7 +129,7 @@ def post_activity_kill(conn, config, http_context):
     ])
     ret = {'backends': []}
     for pid in http_context['post']['pids']:
-        conn.execute("SELECT pg_terminate_backend(%s) AS killed" % (pid))
+        conn.execute("SELECT pg_terminate_backend(%s) AS killed", (pid,))
         # Push a notification.
         try:
             NotificationMgmt.push(config,
@@ -176,21 +175,20 @@ WHERE
 ORDER BY
   EXTRACT(epoch FROM (NOW() - pg_stat_activity.query_start)) DESC
     """
-    conn.execute(query)
     backend_list = []
-    for row in conn.get_rows():
+    for row in conn.execute_iter(query, row_factory='namedtuple'):
         try:
             backend_list.append({
-                'pid': row['pid'],
-                'database': row['database'],
-                'user': row['user'],
-                'mode': row['mode'],
-                'type': row['type'],
-                'relation': row['relation'],
-                'duration': row['duration'],
-                'state': row['state'],
-                'query': row['query'],
-                'process': Process(row['pid'], mem_total, page_size)})
+                'pid': row.pid,
+                'database': row.database,
+                'user': row.user,
+                'mode': row.mode,
+                'type': row.type,
+                'relation': row.relation,
+                'duration': row.duration,
+                'state': row.state,
+                'query': row.query,
+                'process': Process(row.pid, mem_total, page_size)})
         except Exception:
             pass
 
@@ -287,21 +285,20 @@ GROUP BY pid, query, mode, locktype, duration, datname, usename, relation,
   state
 ORDER BY duration DESC
     """
-    conn.execute(query)
     backend_list = []
-    for row in conn.get_rows():
+    for row in conn.execute_iter(query, row_factory='namedtuple'):
         try:
             backend_list.append({
-                'pid': row['pid'],
-                'database': row['database'],
-                'user': row['user'],
-                'mode': row['mode'],
-                'type': row['type'],
-                'relation': row['relation'],
-                'duration': row['duration'],
-                'state': row['state'],
-                'query': row['query'],
-                'process': Process(row['pid'], mem_total, page_size)})
+                'pid': row.pid,
+                'database': row.database,
+                'user': row.user,
+                'mode': row.mode,
+                'type': row.type,
+                'relation': row.relation,
+                'duration': row.duration,
+                'state': row.state,
+                'query': row.query,
+                'process': Process(row.pid, mem_total, page_size)})
         except Exception:
             pass
 
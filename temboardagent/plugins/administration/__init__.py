@@ -99,7 +99,8 @@ def post_pg_control(http_context, config=None, sessions=None):
                 port=config.postgresql['port'],
                 user=config.postgresql['user'],
                 password=config.postgresql['password'],
-                database=config.postgresql['dbname']
+                database=config.postgresql['dbname'],
+                connect_timeout=config.postgresql['connect_timeout']
             )
             # When a start/restart operation is requested, after the
             # startup/pg_ctl script has been executed then we check that
@@ -134,7 +135,8 @@ def post_pg_control(http_context, config=None, sessions=None):
                 port=config.postgresql['port'],
                 user=config.postgresql['user'],
                 password=config.postgresql['password'],
-                database=config.postgresql['dbname']
+                database=config.postgresql['dbname'],
+                connect_timeout=config.postgresql['connect_timeout']
             )
             # Check the PG conn is not working anymore.
             try:
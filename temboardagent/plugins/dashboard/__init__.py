@@ -26,7 +26,7 @@ from temboardagent.errors import (
     SharedItem_exists,
     SharedItem_no_free_slot_left,
 )
-from temboardagent.queue import Queue, Message
+from temboardagent.queue import RingQueue, Message
 import dashboard.config as config_module
 import dashboard.metrics as metrics
 
@@ -225,7 +225,8 @@ def dashboard_collector_worker(config):
             port=config['postgresql']['port'],
             user=config['postgresql']['user'],
             password=config['postgresql']['password'],
-            database=config['postgresql']['dbname']
+            database=config['postgresql']['dbname'],
+            connect_timeout=config['postgresql']['connect_timeout']
         )
         conn.connect()
         # convert config dict to namedtuple
@@ -244,11 +245,9 @@ def dashboard_collector_worker(config):
 
         # We don't want to store notifications in the history.
         data.pop('notifications', None)
-        q = Queue('%s/dashboard.q' % (config['temboard']['home']),
-                  max_length=(config['plugins']['dashboard']['history_length']
-                              +1),
-                  overflow_mode='slide'
-                  )
+        q = RingQueue('%s/dashboard.q' % (config['temboard']['home']),
+                      max_length=(config['plugins']['dashboard']
+                                  ['history_length'] + 1))
         q.push(Message(content=json.dumps(data)))
         logger.debug(data)
         logger.debug("End")
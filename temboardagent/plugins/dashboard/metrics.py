@@ -2,15 +2,17 @@ import time
 from os import getloadavg
 import re
 
-from temboardagent.queue import Queue
+from temboardagent.queue import RingQueue
 from temboardagent.notification import NotificationMgmt
 from temboardagent.inventory import SysInfo, PgInfo
+from temboardagent.utils import JSONArray
 
 
 def get_metrics(conn, config, _=None):
     dm = DashboardMetrics(conn)
     sysinfo = SysInfo()
-    pginfo = PgInfo(conn)
+    # Gather PostgreSQL metrics in a single round trip.
+    dm.prefetch()
 
     cpu_models = [cpu['model_name'] for cpu in sysinfo.cpu_info()['cpus']]
     cpu_models_counter = {}
@@ -31,14 +33,14 @@ def get_metrics(conn, config, _=None):
             'databases': dm.get_stat_db(),
             'pg_uptime': dm.get_pg_uptime(),
             'n_cpu': sysinfo.n_cpu(),
-            'pg_version': pginfo.version()['full'],
-            'pg_data': pginfo.setting('data_directory'),
-            'pg_port': pginfo.setting('port'),
+            'pg_version': dm.get_pg_version(),
+            'pg_data': dm.get_setting('data_directory'),
+            'pg_port': dm.get_setting('port'),
             'notifications': dm.get_notifications(config)}
 
 
 def get_metrics_queue(config, _=None):
-    q = Queue('%s/dashboard.q' % (config.temboard['home']))
+    q = RingQueue('%s/dashboard.q' % (config.temboard['home']))
     dm = DashboardMetrics()
     msg = q.get_last_message()
     msg['notifications'] = dm.get_notifications(config)
@@ -46,8 +48,8 @@ def get_metrics_queue(config, _=None):
 
 
 def get_history_metrics_queue(config, _=None):
-    q = Queue('%s/dashboard.q' % (config.temboard['home']))
-    return q.get_content_all_messages()
+    q = RingQueue('%s/dashboard.q' % (config.temboard['home']))
+    return JSONArray(q.get_content_all_messages(raw=True))
 
 
 def get_info(conn, config, _):
@@ -144,8 +146,66 @@ class DashboardMetrics(object):
     config = None
     _instance = None
 
+    HITRATIO_QUERY = """
+SELECT CASE sum(blks_hit+blks_read) WHEN 0 THEN NULL ELSE
+  trunc(sum(blks_hit)/sum(blks_hit+blks_read)*100) END
+  AS hitratio FROM pg_stat_database
+        """
+
+    SETTINGS_QUERY = """
+SELECT name, setting FROM pg_settings
+WHERE name IN ('max_connections', 'data_directory', 'port')
+            """
+
+    STAT_DB_QUERY = """
+SELECT
+  count(datid) as databases,
+  pg_size_pretty(sum(pg_database_size(
+    pg_database.datname))::bigint) as total_size,
+  to_char(now(),'HH24:MI') as time,
+  sum(xact_commit)::BIGINT as total_commit,
+  sum(xact_rollback)::BIGINT as total_rollback
+FROM
+  pg_database
+  JOIN pg_stat_database ON (pg_database.oid = pg_stat_database.datid)
+WHERE
+  datistemplate = 'f'
+        """
+
+    UPTIME_QUERY = """
+SELECT date_trunc('seconds', NOW() - pg_postmaster_start_time()) AS uptime
+        """
+
+    VERSION_QUERY = "SELECT version()"
+
+    BUFFERS_QUERY = "SELECT buffers_alloc FROM pg_stat_bgwriter"
+
+    # Cancel prefetch queries after this delay, in seconds, rather than
+    # piling up stuck collectors.
+    PREFETCH_TIMEOUT = 30
+
     def __init__(self, conn=None):
         self.conn = conn
+        # Rows of prefetched queries, by query.
+        self._results = {}
+
+    def prefetch(self):
+        # Run all queries in a single round trip. get_* methods then use
+        # their results instead of querying PostgreSQL.
+        queries = [
+            self.BUFFERS_QUERY, self.HITRATIO_QUERY,
+            self._active_backends_query(), self.SETTINGS_QUERY,
+            self.STAT_DB_QUERY, self.UPTIME_QUERY, self.VERSION_QUERY,
+        ]
+        results = self.conn.execute_batch(
+            queries, timeout=self.PREFETCH_TIMEOUT)
+        self._results.update(zip(queries, results))
+
+    def _fetch(self, query):
+        if query in self._results:
+            return self._results[query]
+        self.conn.execute(query)
+        return list(self.conn.get_rows())
 
     def get_buffers(self,):
         current_time = time.time()
@@ -154,11 +214,7 @@ class DashboardMetrics(object):
                 'time': current_time}
 
     def get_hitratio(self,):
-        query = """SELECT CASE sum(blks_hit+blks_read) WHEN 0 THEN NULL ELSE
-        trunc(sum(blks_hit)/sum(blks_hit+blks_read)*100) END
-        AS hitratio FROM pg_stat_database"""
-        self.conn.execute(query)
-        return list(self.conn.get_rows())[0]['hitratio']
+        return self._fetch(self.HITRATIO_QUERY)[0]['hitratio']
 
     def get_active_backends(self,):
         current_time = time.time()
@@ -167,11 +223,14 @@ class DashboardMetrics(object):
                 'time': current_time}
 
     def get_max_connections(self):
-        query = """
-SELECT setting FROM pg_settings WHERE name = 'max_connections'
-            """
-        self.conn.execute(query)
-        return int(list(self.conn.get_rows())[0]['setting'])
+        return int(self.get_setting('max_connections'))
+
+    def get_setting(self, name):
+        rows = self._fetch(self.SETTINGS_QUERY)
+        return dict((row['name'], row['setting']) for row in rows)[name]
+
+    def get_pg_version(self):
+        return self._fetch(self.VERSION_QUERY)[0]['version']
 
     def get_cpu_usage(self,):
         sysinfo = SysInfo()
@@ -187,22 +246,7 @@ SELECT setting FROM pg_settings WHERE name = 'max_connections'
             return self._get_memory_usage_linux()
 
     def get_stat_db(self,):
-        query = """
-SELECT
-  count(datid) as databases,
-  pg_size_pretty(sum(pg_database_size(
-    pg_database.datname))::bigint) as total_size,
-  to_char(now(),'HH24:MI') as time,
-  sum(xact_commit)::BIGINT as total_commit,
-  sum(xact_rollback)::BIGINT as total_rollback
-FROM
-  pg_database
-  JOIN pg_stat_database ON (pg_database.oid = pg_stat_database.datid)
-WHERE
-  datistemplate = 'f'
-        """
-        self.conn.execute(query)
-        row = list(self.conn.get_rows())[0]
+        row = self._fetch(self.STAT_DB_QUERY)[0]
         return {'databases': row['databases'],
                 'total_size': row['total_size'],
                 'time': row['time'],
@@ -211,11 +255,7 @@ WHERE
                 'timestamp': time.time()}
 
     def get_pg_uptime(self,):
-        query = """
-SELECT date_trunc('seconds', NOW() - pg_postmaster_start_time()) AS uptime
-        """
-        self.conn.execute(query)
-        return list(self.conn.get_rows())[0]['uptime']
+        return self._fetch(self.UPTIME_QUERY)[0]['uptime']
 
     def _get_memory_usage_linux(self,):
         mem_total = 0
@@ -279,21 +319,20 @@ SELECT date_trunc('seconds', NOW() - pg_postmaster_start_time()) AS uptime
         return ret
 
     def _get_current_buffers(self,):
-        query = "SELECT buffers_alloc FROM pg_stat_bgwriter"
-        self.conn.execute(query)
-        return list(self.conn.get_rows())[0]['buffers_alloc']
+        return self._fetch(self.BUFFERS_QUERY)[0]['buffers_alloc']
 
-    def _get_current_active_backends(self,):
+    def _active_backends_query(self,):
         if self.conn.get_pg_version() >= 90200:
-            query = """
+            return """
 SELECT COUNT(*) AS nb FROM pg_stat_activity WHERE state != 'idle'
             """
         else:
-            query = """
+            return """
 SELECT COUNT(*) AS nb FROM pg_stat_activity WHERE current_query != '<IDLE>'
             """
-        self.conn.execute(query)
-        return list(self.conn.get_rows())[0]['nb']
+
+    def _get_current_active_backends(self,):
+        return self._fetch(self._active_backends_query())[0]['nb']
 
     def get_notifications(self, config):
         return list(NotificationMgmt.get_last_n(config, 15))
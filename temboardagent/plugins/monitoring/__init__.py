@@ -1,4 +1,3 @@
-import time
 import os
 import sys
 import re
@@ -250,6 +249,7 @@ def api_run_probe(probe_instance, config):
         'user': config.postgresql['user'],
         'database': config.postgresql['dbname'],
         'password': config.postgresql['password'],
+        'connect_timeout': config.postgresql['connect_timeout'],
         'dbnames': config.plugins['monitoring']['dbnames'],
         'instance': config.postgresql['instance']
     }]
@@ -304,6 +304,7 @@ def monitoring_collector_worker(config):
             'user': config.postgresql['user'],
             'database': config.postgresql['dbname'],
             'password': config.postgresql['password'],
+            'connect_timeout': config.postgresql['connect_timeout'],
             'dbnames': config.plugins['monitoring']['dbnames'],
             'instance': config.postgresql['instance']
         }]
@@ -328,8 +329,12 @@ def monitoring_collector_worker(config):
         }
         logger.debug(output)
         q = Queue('%s/metrics.q' % (config.temboard['home']),
-                  max_size=1024 * 1024 * 10, overflow_mode='slide')
-        q.push(Message(content=json.dumps(output)))
+                  max_size=1024 * 1024 * 10, overflow_mode='slide',
+                  compress=True)
+        evicted = q.push(Message(content=json.dumps(output)))
+        if evicted:
+            logger.warning("Metrics queue is full, %s unsent message(s) "
+                           "lost." % (evicted,))
         logger.debug("Done")
     except Exception as e:
         logger.exception(e)
@@ -349,17 +354,20 @@ def monitoring_sender_worker(config):
                     logging=config['logging']
                 )
 
-    c = 0
+    q = Queue('%s/metrics.q' % (config.temboard['home']),
+              max_size=1024 * 1024 * 10, overflow_mode='slide')
+    cursor = q.cursor('sender')
     logger.debug("Starting sender")
     while True:
-        # Let's do it smoothly..
-        time.sleep(0.5)
-
-        q = Queue('%s/metrics.q' % (config.temboard['home']),
-                  max_size=1024 * 1024 * 10, overflow_mode='slide')
-        msg = q.shift(delete=False)
-        if msg is None:
+        batch = cursor.read_batch(1)
+        if not batch:
+            # Sleep until the collector pushes new metrics, the scheduler
+            # starts a new sender if nothing comes before the next run.
+            if cursor.wait(
+                    config.plugins['monitoring']['scheduler_interval'] / 2):
+                continue
             break
+        offset, msg = batch[0]
         try:
             send_output(config.plugins['monitoring']['ssl_ca_cert_file'],
                         config.plugins['monitoring']['collector_url'],
@@ -377,12 +385,8 @@ def monitoring_sender_worker(config):
             logger.error("Failed")
             sys.exit(1)
 
-        # If everything's fine then remove current msg from the queue
-        q.shift(delete=True, check_msg=msg)
-
-        if c > 60:
-            break
-        c += 1
+        # If everything's fine then move the cursor past current msg
+        cursor.ack(offset)
     logger.debug("Done")
 
 
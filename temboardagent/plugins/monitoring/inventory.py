@@ -50,12 +50,14 @@ def instance_info(conninfo, hostname):
         'port': conninfo['port'],
         'user': conninfo['user'],
         'database': conninfo['database'],
-        'password': conninfo['password']
+        'password': conninfo['password'],
+        'connect_timeout': conninfo['connect_timeout'],
     }
 
     # Try the connection
     conn = connector(conninfo['host'], conninfo['port'], conninfo['user'],
-                     conninfo['password'], conninfo['database'])
+                     conninfo['password'], conninfo['database'],
+                     connect_timeout=conninfo['connect_timeout'])
     try:
         conn.connect()
         # Get PostgreSQL informations using PgInfo
@@ -230,7 +230,8 @@ class SqlProbe(Probe):
 
     def get_version(self, conninfo):
         conn = connector(conninfo['host'], conninfo['port'], conninfo['user'],
-                         conninfo['password'], conninfo['database'])
+                         conninfo['password'], conninfo['database'],
+                         connect_timeout=conninfo['connect_timeout'])
 
         try:
             conn.connect()
@@ -251,7 +252,9 @@ class SqlProbe(Probe):
             database = conninfo['database']
 
         conn = connector(conninfo['host'], conninfo['port'], conninfo['user'],
-                         conninfo['password'], database)
+                         conninfo['password'], database,
+                         connect_timeout=conninfo['connect_timeout'])
+        conn.set_subsystem('monitoring.%s' % self.get_name())
 
         output = []
         try:
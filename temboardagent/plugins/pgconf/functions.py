@@ -39,7 +39,7 @@ SELECT DISTINCT(category) FROM pg_settings ORDER BY category
 
 
 def get_setting(conn, name):
-    conn.execute("SELECT setting FROM pg_settings WHERE name = '%s'" % (name))
+    conn.execute("SELECT setting FROM pg_settings WHERE name = %s", (name,))
     return list(conn.get_rows())[0]['setting']
 
 
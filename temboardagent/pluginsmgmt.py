@@ -33,7 +33,8 @@ def load_plugins_configurations(config):
                 port=config.postgresql['port'],
                 user=config.postgresql['user'],
                 password=config.postgresql['password'],
-                database=config.postgresql['dbname']
+                database=config.postgresql['dbname'],
+                connect_timeout=config.postgresql['connect_timeout']
             )
             """ Trying to get PostgreSQL version number. """
             conn.connect()
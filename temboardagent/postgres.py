@@ -2,38 +2,259 @@
 
 from __future__ import unicode_literals
 
-from .spc import connector
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from .spc import add_hook, connector, error
+
+
+logger = logging.getLogger(__name__)
 
 
 class ConnectionManager(object):
-    def __init__(self, postgres):
+    def __init__(self, postgres, subsystem=None):
         self.postgres = postgres
+        self.subsystem = subsystem
 
     def __enter__(self):
-        self.conn = connector(
+        self.pool = self.postgres.pool
+        self.conn = self.pool.getconn()
+        self.conn.set_subsystem(self.subsystem)
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # A connection left by any exception, e.g. within a suspended
+        # execute_iter(), may have unread messages on the wire: never hand it
+        # to another borrower.
+        self.pool.putconn(self.conn, discard=exc_type is not None)
+
+
+class QueryStats(object):
+    """
+    Statistics of connections and queries run by this process, aggregated by
+    subsystem, operation and statement, with a histogram of durations.
+    """
+
+    # Upper bounds of duration buckets, in milliseconds.
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self, max_statements=500):
+        # Beyond, statements are aggregated without their text.
+        self.max_statements = max_statements
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, stats):
+        # spc hook.
+        key = (stats['subsystem'], stats['operation'], stats['query'])
+        duration = stats['duration'] * 1000
+        with self._lock:
+            entry = self._stats.get(key)
+            if entry is None:
+                if len(self._stats) >= self.max_statements:
+                    key = key[:2] + (None,)
+                entry = self._stats.setdefault(key, dict(
+                    count=0, errors=0, duration=0., max_duration=0.,
+                    round_trips=0, bytes_received=0, rows=0,
+                    histogram=[0] * (len(self.BUCKETS) + 1),
+                ))
+            entry['count'] += 1
+            if stats['error'] is not None:
+                entry['errors'] += 1
+            entry['duration'] += duration
+            entry['max_duration'] = max(entry['max_duration'], duration)
+            entry['round_trips'] += stats['round_trips']
+            entry['bytes_received'] += stats['bytes_received']
+            entry['rows'] += stats['rows'] or 0
+            entry['histogram'][bisect_left(self.BUCKETS, duration)] += 1
+
+    def report(self):
+        # Statistics by statement, longest total duration first. Durations
+        # are in milliseconds, histogram is a list of (upper bound, count).
+        bounds = self.BUCKETS + (None,)
+        with self._lock:
+            report = [
+                dict(
+                    entry,
+                    subsystem=subsystem, operation=operation, query=query,
+                    histogram=list(zip(bounds, entry['histogram'])),
+                )
+                for (subsystem, operation, query), entry
+                in self._stats.items()
+            ]
+        return sorted(report, key=lambda e: e['duration'], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+# Statistics of SQL run by this process, from all connectors.
+query_stats = QueryStats()
+add_hook(query_stats.record)
+
+
+class Pool(object):
+    """
+    Thread-safe and bounded pool of connections to a PostgreSQL server.
+    Connections are checked before being borrowed, recycled once idle or old
+    enough, and their session state is reset when given back.
+    """
+
+    # Like DISCARD ALL, but keeping prepared statements cached by connector.
+    RESET_QUERY = (
+        "SET SESSION AUTHORIZATION DEFAULT; RESET ALL; CLOSE ALL; "
+        "UNLISTEN *; SELECT pg_advisory_unlock_all(); DISCARD TEMP;"
+    )
+
+    def __init__(
+            self, postgres, max_size=4, idle_timeout=300, max_lifetime=3600,
+            wait_timeout=30, reset_query=None):
+        self.postgres = postgres
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.wait_timeout = wait_timeout
+        self.reset_query = reset_query or self.RESET_QUERY
+        # Pools must not be shared across fork(), sockets would be too.
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        # Idle connections with their release time, last released last.
+        self._idle = []
+        # Connection creation time, for borrowed and idle connections.
+        self._created = {}
+        self._busy = 0
+        self._closed = False
+
+    def __repr__(self):
+        return '<%s %s/%s busy>' % (
+            self.__class__.__name__, self._busy, self.max_size)
+
+    def _expired(self, conn, released, now):
+        if now - self._created[conn] > self.max_lifetime:
+            return True
+        return released is not None and now - released > self.idle_timeout
+
+    def _connect(self):
+        conn = connector(
             host=self.postgres.host,
             port=self.postgres.port,
             user=self.postgres.user,
             password=self.postgres.password,
-            database=self.postgres.dbname
+            database=self.postgres.dbname,
+            connect_timeout=self.postgres.connect_timeout,
         )
-        self.conn.connect()
-        return self.conn
+        conn.connect()
+        logger.debug(
+            "Connected to %s in %.3fs.", self.postgres,
+            conn.get_connect_time())
+        return conn
+
+    def _close(self, conn):
+        self._created.pop(conn, None)
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug("Failed to close connection: %s.", e)
+
+    def _reset(self, conn):
+        if conn.get_transaction_status() != 'I':
+            conn.rollback()
+        conn.execute(self.reset_query)
+
+    def getconn(self):
+        # Borrow the most recently used healthy connection, open a new one if
+        # the pool is not full or wait for another thread to release one.
+        stale = []
+        try:
+            with self._cond:
+                if self._closed:
+                    raise error('PGC108', 'FATAL', "Connection pool closed.")
+                deadline = time.time() + self.wait_timeout
+                while True:
+                    now = time.time()
+                    while self._idle:
+                        conn, released = self._idle.pop()
+                        if self._expired(conn, released, now) or \
+                                not conn.is_alive():
+                            stale.append(conn)
+                            continue
+                        self._busy += 1
+                        return conn
+
+                    if self._busy < self.max_size:
+                        self._busy += 1
+                        break
+
+                    if now >= deadline:
+                        raise error('PGC108', 'FATAL',
+                                    "Connection pool exhausted.")
+                    self._cond.wait(deadline - now)
+        finally:
+            for conn in stale:
+                logger.debug("Recycling connection %s.", conn)
+                self._close(conn)
 
-    def __exit__(self, *a):
-        self.conn.close()
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._busy -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._created[conn] = time.time()
+        return conn
+
+    def putconn(self, conn, discard=False):
+        # Give back a borrowed connection. Broken connections are closed.
+        if not discard:
+            try:
+                self._reset(conn)
+            except Exception as e:
+                logger.debug("Failed to reset connection: %s.", e)
+                discard = True
+
+        with self._cond:
+            self._busy -= 1
+            now = time.time()
+            if discard or self._closed or self._expired(conn, None, now):
+                discard = True
+            else:
+                self._idle.append((conn, now))
+            self._cond.notify()
+
+        if discard:
+            self._close(conn)
+
+    def close(self):
+        # Close idle connections. Borrowed ones are closed when given back.
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close(conn)
 
 
 class Postgres(object):
     def __init__(
             self, host=None, port=5432, user=None, password=None, dbname=None,
-            **kw):
+            connect_timeout=10, **kw):
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.dbname = dbname
+        self.connect_timeout = connect_timeout
         self._server_version = None
+        self._pool = None
+        # Threads of the HTTP server must share a single pool.
+        self._pool_lock = threading.Lock()
 
     def __repr__(self):
         return '<%s on %s@%s:%s/%s>' % (
@@ -41,8 +262,37 @@ class Postgres(object):
             self.user, self.host, self.port, self.dbname,
         )
 
-    def connect(self):
-        return ConnectionManager(self)
+    def __getstate__(self):
+        # Sockets and locks can't be pickled, the copy will open its own pool.
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        del state['_pool_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pool_lock = threading.Lock()
+
+    @property
+    def pool(self):
+        pool = self._pool
+        if pool is None or pool.pid != os.getpid():
+            with self._pool_lock:
+                pool = self._pool
+                if pool is None or pool.pid != os.getpid():
+                    # Connections inherited from a parent process are still
+                    # used by the parent: forget them without closing.
+                    pool = self._pool = Pool(self)
+        return pool
+
+    def connect(self, subsystem=None):
+        return ConnectionManager(self, subsystem)
+
+    def close(self):
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None and pool.pid == os.getpid():
+            pool.close()
 
     def fetch_version(self):
         if self._server_version is None:
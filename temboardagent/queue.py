@@ -1,8 +1,59 @@
+import errno
 import fcntl
+import mmap
 import os
+import select
+import shutil
+import struct
 import time
 import hashlib
 import json
+import zlib
+from contextlib import contextmanager
+
+
+# Record header: magic, payload length, CRC32 of the rest of the record,
+# message id, flags.
+RECORD_HEADER = struct.Struct('!2sLLQB')
+# Marks the start of each record, to find the next one after a corruption.
+RECORD_MAGIC = b'\xb7\x52'
+# Record flag: payload is compressed with zlib.
+RECORD_ZLIB = 0x01
+# Sparse index entry: message id, offset of the message in the log.
+INDEX_ENTRY = struct.Struct('!QQ')
+# Ring file header: magic, number of slots, slot size, sequence counter,
+# number of messages pushed so far.
+RING_HEADER = struct.Struct('!8sLLQQ')
+RING_MAGIC = b'TBRING01'
+# Offset of the sequence counter in the ring file header.
+RING_SEQ_OFFSET = 16
+# Ring slot header: content length, message id.
+RING_SLOT = struct.Struct('!LQ')
+# Lock-free read attempts before waiting for writers' lock.
+RING_READ_RETRIES = 1000
+
+
+def _record_crc(header, data):
+    """
+    Return the CRC32 of a record: header, length included, but the CRC field
+    itself, and payload.
+    """
+    return zlib.crc32(header[:6] + header[10:] + data) & 0xffffffff
+
+
+def _bisect(n, key, value):
+    """
+    Binary search among n items sorted by key(i). Returns the number of items
+    whose key is lower or equal to value.
+    """
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key(mid) <= value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
 
 
 class Message(object):
@@ -12,25 +63,65 @@ class Message(object):
             self.id = int(time.time() * 1000000)
         else:
             self.id = id
-        if sign is None:
-            self.sign = hashlib.md5(content.encode('utf-8')).hexdigest()[0:9]
-        else:
-            self.sign = sign
+        self._sign = sign
         self.content = content
 
-    def serialize(self,):
-        return "%s:%s:%s\n" % (str(self.id), self.sign, self.content)
+    @property
+    def sign(self):
+        # Records are checked with CRC32, the signature is only computed when
+        # requested.
+        if self._sign is None:
+            self._sign = hashlib.md5(
+                self.content.encode('utf-8')).hexdigest()[0:9]
+        return self._sign
+
+    def serialize(self, compress=False):
+        """
+        Return the message as a record: a fixed size header followed by the
+        content, optionally compressed when it saves space.
+        """
+        data = self.content
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        flags = 0
+        if compress:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= RECORD_ZLIB
+        header = RECORD_HEADER.pack(
+            RECORD_MAGIC, len(data), 0, int(self.id), flags)
+        return RECORD_HEADER.pack(
+            RECORD_MAGIC, len(data), _record_crc(header, data), int(self.id),
+            flags) + data
 
 
 class Queue(object):
-    """On disk queueing system."""
+    """
+    On disk queueing system.
+
+    A queue is a directory holding an append-only log split into segment
+    files. Each segment file is named after the offset of its first byte in
+    the log. Consuming messages only moves the head offset forward, and a
+    segment file is deleted as a whole once the head has gone past it. Queue
+    content is never rewritten.
+
+    Messages are stored as length-prefixed records starting with a magic
+    number and checked with CRC32, so that a record torn by a crash or
+    corrupted is detected and skipped.
+
+    Consumers waiting for new messages listen on a named pipe in the queue
+    directory, a byte is written to it on each push.
+    """
 
     def __init__(self, file_path, max_size=-1, max_length=-1,
-                 overflow_mode='slide'):
+                 overflow_mode='slide', segment_size=1024 * 1024,
+                 index_interval=4096, compress=False, fsync='none',
+                 fsync_interval=1):
         """
         Constructor
 
-        file_path: queue file path
+        file_path: queue directory path
         max_size: maximum queue size (bytes), default -1: no limit
         max_length: maximum queue length, default -1: no limit
         overflow_mode: behaviour to have when queue size or length exceed the
@@ -38,6 +129,18 @@ class Queue(object):
                        - 'slide': the oldest message is removed and the new
                        one pushed.
                        - 'drop': the new message is dropped.
+        segment_size: size (bytes) from which a new segment file is started,
+                      default 1MB
+        index_interval: number of bytes between two entries of the segments
+                        sparse index, default 4kB
+        compress: compress each message with zlib, default False
+        fsync: durability policy of pushed messages, available values are:
+               - 'none': flushing to disk is left to the OS.
+               - 'batch': each push is flushed to disk before returning.
+               - 'interval': pushed messages are flushed to disk at most
+               every fsync_interval seconds.
+        fsync_interval: seconds between two flushes in 'interval' mode,
+                        default 1
         """
         self.file_path = file_path
         self.max_size = max_size
@@ -46,178 +149,889 @@ class Queue(object):
         else:
             self.max_length = -1
         self.overflow_mode = overflow_mode
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.compress = compress
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+
+    def _setup(self):
+        """
+        Create the queue directory. Messages of a queue file written by a
+        previous version of the agent are imported in the first segment.
+        """
+        if os.path.isdir(self.file_path):
+            return
+        # Processes opening the queue at the same time must not both
+        # migrate it. The directory is built aside and renamed into place,
+        # so that it is never seen half done. The lock file is dropped once
+        # the directory exists: late comers check it again under the lock.
+        lock_path = self.file_path + '.lock'
+        with open(lock_path, 'a') as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.path.isdir(self.file_path):
+                    return
+                tmp_dir = '%s.%s.tmp' % (self.file_path, os.getpid())
+                if os.path.isdir(tmp_dir):
+                    shutil.rmtree(tmp_dir)
+                os.makedirs(tmp_dir)
+                legacy_path = None
+                if os.path.isfile(self.file_path):
+                    self._import_legacy(self.file_path, tmp_dir)
+                    legacy_path = '%s.%s.legacy' % (
+                        self.file_path, os.getpid())
+                    os.rename(self.file_path, legacy_path)
+                os.rename(tmp_dir, self.file_path)
+                if legacy_path is not None:
+                    os.remove(legacy_path)
+                os.remove(lock_path)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _import_legacy(self, legacy_path, directory):
+        """
+        Convert a queue file made of 'id:sign:content' lines into the first
+        segment of the log, in directory.
+        """
+        segment_path = os.path.join(
+            directory, os.path.basename(self._segment_path(0)))
+        with open(legacy_path, 'rb') as legacy, \
+                open(segment_path, 'wb') as fd:
+            for row in legacy:
+                try:
+                    (id, sign, content) = row.split(b':', 2)
+                    fd.write(Message(int(id), sign, content.strip())
+                             .serialize(self.compress))
+                except ValueError:
+                    pass
+
+    @contextmanager
+    def _lock(self, operation):
+        """ Hold a lock on the queue during the execution of a block. """
+        self._setup()
+        with open(os.path.join(self.file_path, 'lock'), 'a') as fd:
+            fcntl.flock(fd, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _notify(self):
+        """
+        Wake up consumers waiting for new messages, if any.
+        """
+        try:
+            fd = os.open(os.path.join(self.file_path, 'notify'),
+                         os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            # No FIFO or nobody listening.
+            return
+        try:
+            os.write(fd, b'\0')
+        except OSError:
+            # The pipe is full: consumers are already notified.
+            pass
+        finally:
+            os.close(fd)
+
+    def _open_notify(self):
+        """
+        Open the notification FIFO for reading. Opening it in read-write mode
+        keeps it from being reported readable at EOF when no producer is
+        connected.
+        """
+        self._setup()
+        path = os.path.join(self.file_path, 'notify')
+        try:
+            os.mkfifo(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+    def _segment_path(self, base):
+        return os.path.join(self.file_path, '%020d.log' % (base,))
+
+    def _index_path(self, base):
+        return os.path.join(self.file_path, '%020d.idx' % (base,))
+
+    def _segments(self):
+        """ Return the sorted list of segments base offset. """
+        return sorted(int(filename[:-4])
+                      for filename in os.listdir(self.file_path)
+                      if filename.endswith('.log'))
+
+    def _read_meta(self, segments):
+        """
+        Return queue metadata: head and tail offsets of the log, number of
+        messages in between, number of messages appended to each segment and
+        consumer cursors offset. Metadata are kept in a sidecar file updated
+        along with each change of the log, they are rebuilt from the segments
+        when this file is missing.
+        """
+        try:
+            with open(os.path.join(self.file_path, 'meta'), 'r') as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            pass
+        meta = {
+            'head': segments[0] if segments else 0,
+            'length': 0,
+            'counts': dict((str(base), 0) for base in segments),
+            'cursors': {},
+        }
+        if segments:
+            last = segments[-1]
+            meta['tail'] = last + os.path.getsize(self._segment_path(last))
+        else:
+            meta['tail'] = 0
+        # Bytes following the last valid record, torn by a crash, are not
+        # part of the log: the next push overwrites them.
+        tail = segments[-1] if segments else 0
+        for offset, _, _ in self._read_records(meta, segments):
+            i = _bisect(len(segments), lambda i: segments[i], offset - 1)
+            meta['counts'][str(segments[i - 1])] += 1
+            meta['length'] += 1
+            tail = max(tail, offset)
+        meta['tail'] = tail
+        return meta
+
+    def _write_meta(self, meta, sync=False):
+        """
+        Atomically replace queue metadata. Must be called with an exclusive
+        lock held. With sync, the new metadata are flushed to disk.
+        """
+        path = os.path.join(self.file_path, 'meta')
+        with open(path + '.tmp', 'w') as fd:
+            json.dump(meta, fd)
+            if sync:
+                fd.flush()
+                os.fsync(fd.fileno())
+        os.rename(path + '.tmp', path)
+        if sync:
+            dir_fd = os.open(self.file_path, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def _move_head(self, meta, head, n, segments):
+        """
+        Drop n messages by moving the head offset forward. Segments lying
+        entirely before the new head are forgotten.
+        """
+        meta['head'] = head
+        meta['length'] -= n
+        for i in range(len(segments) - 1):
+            if segments[i + 1] > head:
+                break
+            meta['counts'].pop(str(segments[i]), None)
+
+    def _compact(self, meta, segments):
+        """
+        Move the head to the first segment not entirely read by all consumer
+        cursors. Messages of the segments left behind are only accounted
+        using counts of the remaining segments: none of them is read.
+        """
+        if not meta['cursors']:
+            return False
+        low = min(meta['cursors'].values())
+        i = 0
+        while i < len(segments) - 1 and segments[i + 1] <= low:
+            i += 1
+        if segments[i] <= meta['head']:
+            return False
+        length = sum(meta['counts'].get(str(base), 0)
+                     for base in segments[i:])
+        self._move_head(meta, segments[i], meta['length'] - length, segments)
+        return True
+
+    def _remove_segments(self, head, segments):
+        """
+        Delete the segments lying entirely before the head offset. The last
+        segment is always kept because its name carries the log tail offset.
+        Metadata must have been written first.
+        """
+        for i in range(len(segments) - 1):
+            if segments[i + 1] > head:
+                break
+            os.remove(self._segment_path(segments[i]))
+            if os.path.exists(self._index_path(segments[i])):
+                os.remove(self._index_path(segments[i]))
+
+    def _read_index(self, base):
+        """
+        Return the raw sparse index of a segment. Each entry maps the id of a
+        message to its offset, an entry is added every index_interval bytes.
+        """
+        try:
+            with open(self._index_path(base), 'rb') as fd:
+                return fd.read()
+        except IOError:
+            return b''
+
+    def _first_id(self, base):
+        """ Return the id of the first message of a segment. """
+        index = self._read_index(base)
+        if len(index) >= INDEX_ENTRY.size:
+            return INDEX_ENTRY.unpack_from(index)[0]
+        # Segment not indexed, imported from a queue file.
+        with open(self._segment_path(base), 'rb') as fd:
+            return RECORD_HEADER.unpack(fd.read(RECORD_HEADER.size))[3]
+
+    def _seek_id(self, id, segments):
+        """
+        Return the offset of a message with an id lower or equal to the given
+        one and close enough to it, using a binary search among segments and
+        then among sparse index entries of the segment.
+        """
+        i = _bisect(len(segments), lambda i: self._first_id(segments[i]), id)
+        if i == 0:
+            return segments[0]
+        base = segments[i - 1]
+        index = self._read_index(base)
+        j = _bisect(len(index) // INDEX_ENTRY.size,
+                    lambda j: INDEX_ENTRY.unpack_from(
+                        index, j * INDEX_ENTRY.size)[0],
+                    id)
+        if j == 0:
+            return base
+        return INDEX_ENTRY.unpack_from(index, (j - 1) * INDEX_ENTRY.size)[1]
+
+    def _truncate_index(self, base, tail):
+        """ Remove index entries pointing at or after tail. """
+        index = self._read_index(base)
+        n = len(index) // INDEX_ENTRY.size
+        while n > 0 and INDEX_ENTRY.unpack_from(
+                index, (n - 1) * INDEX_ENTRY.size)[1] >= tail:
+            n -= 1
+        with open(self._index_path(base), 'r+b') as fd:
+            fd.truncate(n * INDEX_ENTRY.size)
+
+    def _trim(self, meta, segments):
+        """
+        Find how many of the oldest messages must go for the queue to fit its
+        limits and move the head past all of them at once. Only evicted
+        records are read. Returns the number of evicted messages and, among
+        them, the number of messages not yet acknowledged by all consumer
+        cursors.
+        """
+        n = 0
+        unread = 0
+        head = meta['head']
+        low = min(meta['cursors'].values()) if meta['cursors'] else head
+        for offset, _, _ in self._read_records(meta, segments):
+            if not ((self.max_length > -1 and
+                     meta['length'] - n > self.max_length) or
+                    (self.max_size > -1 and
+                     meta['tail'] - head > self.max_size)):
+                break
+            head = offset
+            n += 1
+            if offset > low:
+                unread += 1
+        self._move_head(meta, head, n, segments)
+        return n, unread
+
+    def _read_segment(self, fd, base, start, end):
+        """
+        Generator reading the records of an opened segment file between two
+        offsets, returning for each record the offset following it, the
+        message id and its content. On a record failing its checksum, its
+        length can't be trusted: reading goes on with the next valid record
+        found after its start. A truncated record ends the segment.
+        """
+        fd.seek(start - base)
+        offset = start
+        while offset + RECORD_HEADER.size <= end:
+            header = fd.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            (magic, length, crc, id, flags) = RECORD_HEADER.unpack(header)
+            next_offset = offset + RECORD_HEADER.size + length
+            if magic == RECORD_MAGIC and next_offset <= end:
+                data = fd.read(length)
+                if len(data) == length and _record_crc(header, data) == crc:
+                    offset = next_offset
+                    if flags & RECORD_ZLIB:
+                        data = zlib.decompress(data)
+                    yield (offset, id, data)
+                    continue
+            offset = self._resync(fd, base, offset + 1, end)
+            if offset is None:
+                return
+            fd.seek(offset - base)
+
+    def _resync(self, fd, base, start, end):
+        """
+        Return the offset of the first valid record found between two offsets
+        of an opened segment file, or None.
+        """
+        fd.seek(start - base)
+        data = fd.read(end - start)
+        pos = data.find(RECORD_MAGIC)
+        while pos != -1 and pos + RECORD_HEADER.size <= len(data):
+            header = data[pos:pos + RECORD_HEADER.size]
+            (_, length, crc, _, _) = RECORD_HEADER.unpack(header)
+            payload_start = pos + RECORD_HEADER.size
+            if payload_start + length <= len(data) and _record_crc(
+                    header,
+                    data[payload_start:payload_start + length]) == crc:
+                return start + pos
+            pos = data.find(RECORD_MAGIC, pos + 1)
+        return None
+
+    def _read_records(self, meta, segments):
+        """
+        Generator walking through the log from the head to the tail and
+        returning each record as (offset following it, id, content). Records
+        written after the tail by an interrupted push are ignored.
+        """
+        head = meta['head']
+        for i, base in enumerate(segments):
+            if i + 1 < len(segments) and segments[i + 1] <= head:
+                continue
+            if base >= meta['tail']:
+                break
+            end = meta['tail']
+            if i + 1 < len(segments):
+                end = min(end, segments[i + 1])
+            with open(self._segment_path(base), 'rb') as fd:
+                for record in self._read_segment(fd, base, max(head, base),
+                                                 end):
+                    yield record
+
+    def _read_records_backwards(self, meta, segments):
+        """
+        Generator walking through the log from the tail back to the head. As
+        far as the last records are located at the end of the log, segments
+        are read by chunks delimited with sparse index entries, starting from
+        the last one.
+        """
+        head = meta['head']
+        end = meta['tail']
+        for base in reversed(segments):
+            if base >= end:
+                continue
+            index = self._read_index(base)
+            starts = [max(head, base)]
+            for j in range(len(index) // INDEX_ENTRY.size):
+                offset = INDEX_ENTRY.unpack_from(index,
+                                                 j * INDEX_ENTRY.size)[1]
+                if starts[0] < offset < end:
+                    starts.append(offset)
+            with open(self._segment_path(base), 'rb') as fd:
+                for start in reversed(starts):
+                    records = list(self._read_segment(fd, base, start, end))
+                    for record in reversed(records):
+                        yield record
+                    end = start
+            if base <= head:
+                break
 
     def get_length(self,):
-        """ Read the whole queue file and return the number of lines. """
+        """ Return the number of messages. """
         try:
-            with open(self.file_path, 'r') as fd:
-                fcntl.flock(fd, fcntl.LOCK_SH)
-                n = 0
-                for _ in fd.readlines():
-                    n += 1
-                fcntl.flock(fd, fcntl.LOCK_UN)
-                return n
+            with self._lock(fcntl.LOCK_SH):
+                return self._read_meta(self._segments())['length']
         except Exception:
             return 0
 
     def get_last_message(self):
         return list(self.get_last_n_messages(1))[0]
 
-    def get_last_n_messages(self, n):
+    def get_last_n_messages(self, n, raw=False):
         """
-        Generator intended to return the last n messages from the queue.
-        As far as the last records are located at the end of the file, we read
-        the file backwards until the number of desired lines is reached or the
-        whole file has been read. -1 means no limit.
+        Generator intended to return the last n messages from the queue, the
+        newest first. -1 means no limit. With raw set to True, messages are
+        returned as stored JSON strings instead of being decoded.
         """
-        buf_size = 8192
         try:
-            with open(self.file_path, 'r') as fd:
-                fcntl.flock(fd, fcntl.LOCK_SH)
-                segment = None
-                offset = 0
+            with self._lock(fcntl.LOCK_SH):
+                segments = self._segments()
                 n_line = 0
-                # Move to the EOF
-                fd.seek(0, os.SEEK_END)
-                # Get file size using tell()
-                file_size = total_size = remaining_size = fd.tell()
-
-                while (remaining_size > 0):
-                    offset = min(total_size, offset + buf_size)
-                    # Move pointer to the next position.
-                    fd.seek(file_size - offset)
-                    # Read a chunk into the buffer.
-                    buffer = fd.read(min(remaining_size, buf_size))
-                    remaining_size -= buf_size
-                    # Split buffer content by EOL.
-                    lines = buffer.split('\n')
-
-                    if segment is not None:
-                        # Case when we need to concatenate the first uncomplete
-                        # line of the last loop iter. with the last one of this
-                        # current iteration.
-                        if buffer[-1] is not '\n':
-                            lines[-1] += segment
-                        else:
-                            n_line += 1
-                            if (n > -1 and n_line > n):
-                                fcntl.flock(fd, fcntl.LOCK_UN)
-                                break
-                            yield json.loads(
-                                    self.parse_row_message(segment).content)
-                    segment = lines[0]
-                    # Read each line.
-                    for idx in range(len(lines) - 1, 0, -1):
-                        if len(lines[idx]):
-                            n_line += 1
-                            if (n > -1 and n_line > n):
-                                fcntl.flock(fd, fcntl.LOCK_UN)
-                                break
-                            yield json.loads(
-                                    self.parse_row_message(lines[idx]).content)
-
-                if segment is not None:
-                    yield json.loads(self.parse_row_message(segment).content)
-                fcntl.flock(fd, fcntl.LOCK_UN)
+                for _, _, content in self._read_records_backwards(
+                        self._read_meta(segments), segments):
+                    n_line += 1
+                    if (n > -1 and n_line > n):
+                        break
+                    if raw:
+                        yield content
+                    else:
+                        yield json.loads(content)
         except Exception:
             return
 
-    def get_content_all_messages(self):
+    def get_content_all_messages(self, raw=False):
         """
-        Get all messages
+        Get all messages. With raw set to True, messages are returned as
+        stored JSON strings instead of being decoded.
         """
         try:
             buffers = list()
-            with open(self.file_path, 'r') as fd:
-                fcntl.flock(fd, fcntl.LOCK_SH)
-                for row_msg in fd.readlines():
+            with self._lock(fcntl.LOCK_SH):
+                segments = self._segments()
+                for _, _, content in self._read_records(
+                        self._read_meta(segments), segments):
                     try:
-                        msg = self.parse_row_message(row_msg)
-                        buffers.append(json.loads(msg.content))
+                        if raw:
+                            buffers.append(content)
+                        else:
+                            buffers.append(json.loads(content))
                     except Exception:
                         pass
-                fcntl.flock(fd, fcntl.LOCK_UN)
             return buffers
         except Exception:
             return
 
+    def read_range(self, since_id=None, until_id=None, limit=-1):
+        """
+        Return the messages whose id is greater than since_id and lower or
+        equal to until_id, the oldest first, at most limit messages (-1: no
+        limit). Message ids being timestamps, the first message to read is
+        looked up using sparse indexes, then only the requested window is
+        read. Message content is not decoded.
+        """
+        messages = []
+        try:
+            with self._lock(fcntl.LOCK_SH):
+                segments = self._segments()
+                meta = self._read_meta(segments)
+                if since_id is not None and segments:
+                    meta['head'] = max(meta['head'],
+                                       self._seek_id(since_id, segments))
+                for _, id, content in self._read_records(meta, segments):
+                    if limit > -1 and len(messages) >= limit:
+                        break
+                    if since_id is not None and id <= since_id:
+                        continue
+                    if until_id is not None and id > until_id:
+                        break
+                    messages.append(Message(id, content=content))
+        except Exception:
+            pass
+        return messages
+
     def get_size(self):
-        """ Return queue file size. """
+        """ Return queue size. """
         try:
-            with open(self.file_path, 'r') as fd:
-                fcntl.flock(fd, fcntl.LOCK_SH)
-                size = os.fstat(fd.fileno()).st_size
-                fcntl.flock(fd, fcntl.LOCK_UN)
-                return size
+            with self._lock(fcntl.LOCK_SH):
+                meta = self._read_meta(self._segments())
+                return meta['tail'] - meta['head']
         except Exception:
             return 0
 
     def push(self, message):
-        """ Push a new message. """
-        if self.overflow_mode == 'drop':
-            if self.max_length > -1 and self.get_length() >= self.max_length:
-                return
-            if self.max_size > -1 and self.get_size() >= self.max_size:
-                return
+        """
+        Push a new message.
 
-        with open(self.file_path, 'a') as fd:
-            # Let's hold an exclusive lock.
-            fcntl.flock(fd, fcntl.LOCK_EX)
-            fd.write(message.serialize())
-            fcntl.flock(fd, fcntl.LOCK_UN)
-            fd.close()
+        Returns the number of messages lost because of an overflow: the
+        oldest messages evicted in 'slide' mode before being acknowledged by
+        all consumer cursors, or the new message itself in 'drop' mode.
+        """
+        return self.push_many([message])
 
-        if self.overflow_mode == 'slide':
-            if self.max_size == -1 and self.max_length > -1:
-                while self.get_length() > self.max_length:
-                    self.shift()
-            elif self.max_size > -1 and self.max_length == -1:
-                while self.get_size() > self.max_size:
-                    self.shift()
-
-    def parse_row_message(self, row_message):
-        if row_message:
-            (id, sign) = row_message[:26].split(":")
-            content = row_message[27:]
-            return Message(id, sign, content.strip())
-        else:
-            return
+    def push_many(self, messages):
+        """
+        Push a batch of messages, holding the lock once and issuing a single
+        write per segment file.
+
+        Returns the number of messages lost because of an overflow: the
+        oldest messages evicted in 'slide' mode before being acknowledged by
+        all consumer cursors, or the new messages dropped in 'drop' mode.
+        """
+        records = [(message, message.serialize(self.compress))
+                   for message in messages]
+        lost = 0
+        # Let's hold an exclusive lock.
+        with self._lock(fcntl.LOCK_EX):
+            segments = self._segments()
+            meta = self._read_meta(segments)
+            if self.overflow_mode == 'drop':
+                accepted = []
+                length = meta['length']
+                size = meta['tail'] - meta['head']
+                for message, record in records:
+                    if (self.max_length > -1 and length >= self.max_length) \
+                            or (self.max_size > -1 and size >= self.max_size):
+                        lost += 1
+                        continue
+                    accepted.append((message, record))
+                    length += 1
+                    size += len(record)
+                records = accepted
+            if not records:
+                return lost
+
+            # Drop what an interrupted push wrote after the tail: the
+            # segments it started, then trailing bytes of the last one.
+            while segments and segments[-1] >= meta['tail']:
+                base = segments.pop()
+                os.remove(self._segment_path(base))
+                if os.path.exists(self._index_path(base)):
+                    os.remove(self._index_path(base))
+                meta['counts'].pop(str(base), None)
+            if not segments:
+                segments.append(meta['tail'])
+            base = segments[-1]
+            path = self._segment_path(base)
+            if os.path.exists(path) and \
+                    os.path.getsize(path) > meta['tail'] - base:
+                with open(path, 'r+b') as fd:
+                    fd.truncate(meta['tail'] - base)
+                if os.path.exists(self._index_path(base)):
+                    self._truncate_index(base, meta['tail'])
+
+            # Group records and index entries by segment.
+            chunks = []
+            for message, record in records:
+                if meta['tail'] - base >= self.segment_size:
+                    # Start a new segment.
+                    base = meta['tail']
+                    segments.append(base)
+                if not chunks or chunks[-1][0] != base:
+                    chunks.append((base, [], []))
+                chunks[-1][1].append(record)
+                indexed = meta.get('indexed')
+                if indexed is None or indexed < base or \
+                        meta['tail'] - indexed >= self.index_interval:
+                    chunks[-1][2].append(
+                        INDEX_ENTRY.pack(int(message.id), meta['tail']))
+                    meta['indexed'] = meta['tail']
+                meta['tail'] += len(record)
+                meta['length'] += 1
+                meta['counts'][str(base)] = \
+                    meta['counts'].get(str(base), 0) + 1
+
+            for base, data, entries in chunks:
+                with open(self._segment_path(base), 'ab') as fd:
+                    fd.write(b''.join(data))
+                if entries:
+                    with open(self._index_path(base), 'ab') as fd:
+                        fd.write(b''.join(entries))
+
+            sync = self.fsync == 'batch' or (
+                self.fsync == 'interval' and
+                time.time() - meta.get('synced_time', 0) >=
+                self.fsync_interval)
+            if sync:
+                self._sync(meta, segments)
+
+            evicted = 0
+            if self.overflow_mode == 'slide':
+                evicted, lost = self._trim(meta, segments)
+            self._write_meta(meta, sync)
+            if evicted:
+                self._remove_segments(meta['head'], segments)
+        self._notify()
+        return lost
+
+    def _sync(self, meta, segments):
+        """
+        Flush to disk the segments written since the previous call.
+        """
+        synced = meta.get('synced', 0)
+        for i, base in enumerate(segments):
+            if i + 1 < len(segments) and segments[i + 1] <= synced:
+                continue
+            with open(self._segment_path(base), 'rb') as fd:
+                os.fsync(fd.fileno())
+        meta['synced'] = meta['tail']
+        meta['synced_time'] = time.time()
 
     def shift(self, delete=True, check_msg=None):
         """ Get and remove from the queue the oldest message. """
         try:
-            with open(self.file_path, 'r+') as fd:
-                fcntl.flock(fd, fcntl.LOCK_EX)
-                i = 0
-                row_message = None
-                message = None
-                for line in fd.readlines():
-                    if i == 0:
-                        row_message = line
-                        message = self.parse_row_message(row_message)
-                        if delete is False:
-                            fcntl.flock(fd, fcntl.LOCK_UN)
+            with self._lock(fcntl.LOCK_EX):
+                segments = self._segments()
+                meta = self._read_meta(segments)
+                for offset, id, content in self._read_records(meta,
+                                                              segments):
+                    message = Message(id, content=content)
+                    if delete is False:
+                        return message
+                    if type(check_msg) is Message:
+                        if not (message.id == check_msg.id and
+                                message.sign == check_msg.sign):
                             return message
-                        if type(check_msg) is Message:
-                            if not (message.id == check_msg.id and
-                                    message.sign == check_msg.sign):
-                                fcntl.flock(fd, fcntl.LOCK_UN)
-                                return message
-                        # Go back to the first line.
-                        fd.seek(0)
-                    else:
-                        fd.write(line)
-                    i += 1
-                fd.truncate()
-                fcntl.flock(fd, fcntl.LOCK_UN)
-                fd.close()
-                return message
-        except IOError:
+                    # Only the head offset moves, nothing is rewritten.
+                    self._move_head(meta, offset, 1, segments)
+                    self._write_meta(meta)
+                    self._remove_segments(offset, segments)
+                    return message
+        except (IOError, OSError):
+            pass
+
+    def cursor(self, name):
+        """ Return the named consumer cursor of the queue. """
+        return Cursor(self, name)
+
+
+class Cursor(object):
+    """
+    Named consumer cursor over a queue.
+
+    Reading through a cursor does not remove messages from the queue. The
+    cursor offset is persisted in queue metadata when messages are
+    acknowledged, and segments are removed once every cursor of the queue
+    has gone past them.
+    """
+
+    def __init__(self, queue, name):
+        self.queue = queue
+        self.name = name
+
+    def read_batch(self, n):
+        """
+        Return at most n messages following the last acknowledged one, as a
+        list of (offset, message) tuples. Acknowledging an offset commits
+        the corresponding message and all the previous ones.
+        """
+        q = self.queue
+        batch = []
+        try:
+            with q._lock(fcntl.LOCK_SH):
+                segments = q._segments()
+                meta = q._read_meta(segments)
+                meta['head'] = max(meta['head'],
+                                   meta['cursors'].get(self.name, 0))
+                for offset, id, content in q._read_records(meta, segments):
+                    if len(batch) >= n:
+                        break
+                    batch.append((offset, Message(id, content=content)))
+        except (IOError, OSError):
+            pass
+        return batch
+
+    def _pending(self):
+        """ Are there messages following the cursor position ? """
+        q = self.queue
+        with q._lock(fcntl.LOCK_SH):
+            meta = q._read_meta(q._segments())
+            return meta['tail'] > max(meta['head'],
+                                      meta['cursors'].get(self.name, 0))
+
+    def wait(self, timeout=None):
+        """
+        Block until messages follow the cursor position, without polling.
+        Returns False if timeout (seconds) expired first, None: no timeout.
+        """
+        fd = self.queue._open_notify()
+        try:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._pending():
+                if timeout is None:
+                    remaining = None
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                readable, _, _ = select.select([fd], [], [], remaining)
+                if readable:
+                    # Drain notifications, they are only wake-up calls.
+                    try:
+                        while os.read(fd, 4096):
+                            pass
+                    except OSError:
+                        pass
+            return True
+        finally:
+            os.close(fd)
+
+    def ack(self, offset):
+        """ Commit the cursor position. """
+        q = self.queue
+        with q._lock(fcntl.LOCK_EX):
+            segments = q._segments()
+            meta = q._read_meta(segments)
+            meta['cursors'][self.name] = offset
+            compacted = q._compact(meta, segments)
+            q._write_meta(meta)
+            if compacted:
+                q._remove_segments(meta['head'], segments)
+
+
+class RingQueue(object):
+    """
+    Fixed capacity queue stored in a memory-mapped ring file.
+
+    The file is preallocated with one fixed size slot per message, a push
+    overwrites the oldest slot in place. Writers serialize with a lock on the
+    file while readers take no lock at all: the header holds a sequence
+    counter, odd while a write is in progress, and readers retry their copy
+    until they get the same even value before and after it (seqlock), then
+    fall back to the writers' lock.
+    """
+
+    def __init__(self, file_path, max_length=-1, slot_size=64 * 1024):
+        """
+        Constructor
+
+        file_path: ring file path
+        max_length: number of slots, only required to push messages
+        slot_size: maximum size (bytes) of a message, slot header included,
+                   default 64kB
+        """
+        self.file_path = file_path
+        self.max_length = max_length
+        self.slot_size = slot_size
+
+    def _create(self):
+        """
+        Create the ring file, replacing any existing one. The new file is
+        renamed over the previous one so that readers never map a file being
+        resized.
+        """
+        if os.path.isdir(self.file_path):
+            # Queue directory left by a previous version of the agent.
+            shutil.rmtree(self.file_path)
+        tmp_path = '%s.%s.tmp' % (self.file_path, os.getpid())
+        with open(tmp_path, 'wb') as fd:
+            fd.write(RING_HEADER.pack(RING_MAGIC, self.max_length,
+                                      self.slot_size, 0, 0))
+            # Slots are left as a sparse file.
+            fd.truncate(mmap.PAGESIZE + self.max_length * self.slot_size)
+        os.rename(tmp_path, self.file_path)
+
+    def push(self, message):
+        """
+        Push a new message, overwriting the oldest one once the ring is full.
+        Returns the number of messages overwritten.
+        """
+        content = message.content
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        if RING_SLOT.size + len(content) > self.slot_size:
+            raise ValueError("Message too large for ring slots.")
+
+        while True:
+            try:
+                fd = open(self.file_path, 'r+b')
+            except IOError:
+                self._create()
+                continue
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            header = RING_HEADER.unpack(fd.read(RING_HEADER.size))
             try:
+                replaced = os.fstat(fd.fileno()).st_ino != \
+                    os.stat(self.file_path).st_ino
+            except OSError:
+                replaced = True
+            if header[:3] == (RING_MAGIC, self.max_length, self.slot_size) \
+                    and not replaced:
+                break
+            # Ring geometry changed, or the file has just been replaced.
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            fd.close()
+            self._create()
+
+        try:
+            mm = mmap.mmap(fd.fileno(), 0)
+            try:
+                (_, _, _, seq, count) = RING_HEADER.unpack_from(mm)
+                # An odd counter is left by a writer killed in the middle of
+                # its write: make it even again.
+                seq += seq & 1
+                offset = mmap.PAGESIZE + \
+                    (count % self.max_length) * self.slot_size
+                struct.pack_into('!Q', mm, RING_SEQ_OFFSET, seq + 1)
+                RING_SLOT.pack_into(mm, offset, len(content),
+                                    int(message.id))
+                start = offset + RING_SLOT.size
+                mm[start:start + len(content)] = content
+                RING_HEADER.pack_into(mm, 0, RING_MAGIC, self.max_length,
+                                      self.slot_size, seq + 2, count + 1)
+            finally:
+                mm.close()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            fd.close()
+        return 1 if count >= self.max_length else 0
+
+    def _snapshot(self, n):
+        """
+        Return the number of messages in the ring and a consistent copy of
+        the last n messages contents, the oldest first, -1 meaning all of
+        them. No lock is taken.
+        """
+        try:
+            fd = open(self.file_path, 'rb')
+        except IOError:
+            return (0, [])
+        try:
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            # Empty file, being created.
+            fd.close()
+            return (0, [])
+        retries = 0
+        locked = False
+        try:
+            while True:
+                if not locked and retries >= RING_READ_RETRIES:
+                    # Writers keep changing the ring, or one died while
+                    # writing: read under their lock.
+                    fcntl.flock(fd, fcntl.LOCK_SH)
+                    locked = True
+                retries += 1
+                (magic, max_length, slot_size, seq, count) = \
+                    RING_HEADER.unpack_from(mm)
+                if magic != RING_MAGIC:
+                    return (0, [])
+                if seq & 1 and not locked:
+                    # A write is in progress.
+                    time.sleep(0)
+                    continue
+                total = min(count, max_length)
+                length = total
+                if n > -1:
+                    length = min(length, n)
+                contents = []
+                for i in range(count - length, count):
+                    offset = mmap.PAGESIZE + (i % max_length) * slot_size
+                    (size, _) = RING_SLOT.unpack_from(mm, offset)
+                    start = offset + RING_SLOT.size
+                    contents.append(
+                        mm[start:start + min(size,
+                                             slot_size - RING_SLOT.size)])
+                (last_seq,) = struct.unpack_from('!Q', mm, RING_SEQ_OFFSET)
+                if locked or last_seq == seq:
+                    return (total, contents)
+        finally:
+            if locked:
                 fcntl.flock(fd, fcntl.LOCK_UN)
-            except Exception:
-                pass
-            pass
+            mm.close()
+            fd.close()
+
+    def get_length(self):
+        """ Return the number of messages. """
+        return self._snapshot(0)[0]
+
+    def get_last_message(self):
+        return list(self.get_last_n_messages(1))[0]
+
+    def get_last_n_messages(self, n, raw=False):
+        """
+        Return the last n messages from the ring, the newest first. -1 means
+        no limit. With raw set to True, messages are returned as stored JSON
+        strings instead of being decoded.
+        """
+        contents = reversed(self._snapshot(n)[1])
+        if raw:
+            return list(contents)
+        return [json.loads(content) for content in contents]
+
+    def get_content_all_messages(self, raw=False):
+        """
+        Get all messages, the oldest first. With raw set to True, messages are
+        returned as stored JSON strings instead of being decoded.
+        """
+        contents = self._snapshot(-1)[1]
+        if raw:
+            return contents
+        return [json.loads(content) for content in contents]
 
 
 def purge_queue_dir(queue_dir, exceptions=[]):
@@ -227,4 +1041,8 @@ def purge_queue_dir(queue_dir, exceptions=[]):
     if os.path.exists(queue_dir):
         for filename in os.listdir(queue_dir):
             if filename.endswith(".q") and filename not in exceptions:
-                os.remove("%s/%s" % (queue_dir, filename))
+                path = "%s/%s" % (queue_dir, filename)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
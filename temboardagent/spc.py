@@ -3,12 +3,16 @@ Simple PostgreSQL Connector module.
 author: Julien Tachoires <julien.tachoires@dalibo.com>
 """
 
+import errno
 import socket
 import ssl
 import hashlib
 import struct
 import re
-from io import BytesIO
+import time
+import select
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 import datetime
 
 
@@ -63,12 +67,104 @@ def pg_escape(in_string, escapee_char=r"'"):
     return out_string
 
 
+# Functions called with statistics of connectors operations.
+_hooks = []
+
+
+def add_hook(hook):
+    """
+    Register a function called after each connection, query or rows fetch
+    of any connector, with a dict of statistics: operation, query,
+    subsystem, duration in seconds, round_trips, bytes_received, rows and
+    error code if any. Hooks are called synchronously and must not raise.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """
+    Unregister a function added with add_hook().
+    """
+    _hooks.remove(hook)
+
+
+# Resolved addresses by (host, port), with their expiration time.
+_addresses = {}
+_addresses_ttl = 60  # Seconds
+
+
+def _resolve(host, port):
+    """
+    Classify host as an IPv4 or IPv6 address, a Unix socket directory or a
+    hostname to resolve. Returns (ip4, ip6, unix), cached for a while.
+    """
+    now = time.time()
+    expires, addresses = _addresses.get((host, port), (0, None))
+    if expires > now:
+        return addresses
+
+    ip4 = ip6 = unix = None
+    # ip4
+    if re.match(r'(?:[3-9]\d?|2(?:5[0-5]|[0-4]?\d)?|1\d{0,2}|\d)'
+                '(\.(?:[3-9]\d?|2(?:5[0-5]|[0-4]?\d)?|1\d{0,2}|\d)){3}$',
+                host):
+        ip4 = host
+    # ip6
+    elif re.match(r'^[0-9a-fA-F]+:([0-9a-fA-F]*:*){0,6}:[0-9a-fA-F]+$',
+                  host):
+        ip6 = host
+    # unix socket
+    elif re.match(r'^\/.*', host):
+        unix = host
+    # hostname
+    else:
+        try:
+            for addr in socket.getaddrinfo(host,
+                                           port,
+                                           socket.AF_UNSPEC,
+                                           socket.SOCK_STREAM):
+                if addr[0] == socket.AF_INET:
+                    ip4 = addr[4][0]
+                if addr[0] == socket.AF_INET6:
+                    ip6 = addr[4][0]
+        except socket.gaierror:
+            raise error('PGC404', 'FATAL', "Unknown name or service"
+                        " '{host}'".format(host=host))
+
+    addresses = (ip4, ip6, unix)
+    _addresses[(host, port)] = (now + _addresses_ttl, addresses)
+    return addresses
+
+
+# SSL context shared by connections.
+_ssl_context = None
+
+
+def _wrap_ssl(sock):
+    """
+    Wrap a socket with SSL, without certificate verification.
+    """
+    global _ssl_context
+    if not hasattr(ssl, 'SSLContext'):
+        return ssl.wrap_socket(sock)
+    if _ssl_context is None:
+        _ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    return _ssl_context.wrap_socket(sock)
+
+
+# DataRow message length and number of columns, and column value length.
+_data_row_header = struct.Struct('!LH')
+_column_length = struct.Struct('!l')
+_copy_binary_signature = b'PGCOPY\n\xff\r\n\x00'
+
+
 class protocol3(object):
     """
     PostgreSQL FE/BE protocol 3.0 implementation.
     """
     _version = 196608
     _ssl_code = 80877103
+    _cancel_code = 80877102
 
     def __init__(self,):
         # Response parsers mapping
@@ -86,10 +182,15 @@ class protocol3(object):
             b'c': 'parse_copy_done',
             b'N': 'parse_notice',
             b'W': 'parse_copy_both_response',
+            b'A': 'parse_notification',
             # Not implemented
-            b'A': 'ignore',  # Notification
             b'n': 'ignore',  # No Data
             b'I': 'ignore',  # Empty query
+            b'1': 'ignore',  # Parse complete
+            b'2': 'ignore',  # Bind complete
+            b'3': 'ignore',  # Close complete
+            b't': 'ignore',  # Parameter description
+            b's': 'ignore',  # Portal suspended
         }
 
     def ssl_request(self,):
@@ -98,6 +199,13 @@ class protocol3(object):
         """
         return struct.pack('!L', 8) + struct.pack('!L', self._ssl_code)
 
+    def cancel_request(self, pid, key):
+        """
+        CancelRequest, sent on a new connection to cancel the query running
+        on backend pid.
+        """
+        return struct.pack('!LLLL', 16, self._cancel_code, pid, key)
+
     def startup(self, user, database='', replication=False):
         """
         Startup packet.
@@ -130,6 +238,57 @@ class protocol3(object):
         data = query.encode() + b'\x00'
         return b'Q' + struct.pack('!L', len(data) + 4) + data
 
+    def parse(self, name, query):
+        """
+        Parse message, extended query mode. Parameter types are left for
+        the backend to infer.
+        """
+        data = name.encode() + b'\x00' + query.encode() + b'\x00' \
+            + struct.pack('!H', 0)
+        return b'P' + struct.pack('!L', len(data) + 4) + data
+
+    def bind(self, name, parameters, formats=(), portal=''):
+        """
+        Bind message, extended query mode. Parameters are sent as text, None
+        being NULL. Result columns formats are text (0) unless specified.
+        """
+        data = portal.encode() + b'\x00' + name.encode() + b'\x00' \
+            + struct.pack('!HH', 0, len(parameters))
+        for value in parameters:
+            if value is None:
+                data += struct.pack('!l', -1)
+            else:
+                data += struct.pack('!l', len(value)) + value
+        data += struct.pack('!H%dh' % len(formats), len(formats), *formats)
+        return b'B' + struct.pack('!L', len(data) + 4) + data
+
+    def describe(self, kind, name=''):
+        """
+        Describe message, kind is 'S' for a statement or 'P' for a portal.
+        """
+        data = kind.encode() + name.encode() + b'\x00'
+        return b'D' + struct.pack('!L', len(data) + 4) + data
+
+    def execute(self, portal='', max_rows=0):
+        """
+        Execute message, extended query mode.
+        """
+        data = portal.encode() + b'\x00' + struct.pack('!L', max_rows)
+        return b'E' + struct.pack('!L', len(data) + 4) + data
+
+    def close(self, kind, name):
+        """
+        Close message, kind is 'S' for a statement or 'P' for a portal.
+        """
+        data = kind.encode() + name.encode() + b'\x00'
+        return b'C' + struct.pack('!L', len(data) + 4) + data
+
+    def sync(self,):
+        """
+        Sync message, ends an extended query cycle.
+        """
+        return b'S' + struct.pack('!L', 4)
+
     def copy_data(self, sdata):
         data = b'd' + struct.pack('!L', len(sdata) + 4) + sdata
         return data
@@ -234,6 +393,20 @@ class protocol3(object):
         }
         return (data[0:1], extra)
 
+    def parse_notification(self, data):
+        """
+        NotificationResponse parser.
+        """
+        length = struct.unpack('!L', data[1:5])[0]
+        self._check_message_length(data, length)
+        channel, payload = data[9:-1].split(b'\x00', 1)
+        extra = {
+            'pid': struct.unpack('!L', data[5:9])[0],
+            'channel': channel.decode(),
+            'payload': payload.decode()
+        }
+        return (data[0:1], extra)
+
     def parse_error(self, data):
         """
         Error parser.
@@ -250,19 +423,18 @@ class protocol3(object):
         """
         RowDescription parser.
         """
-        (length, nb_fields) = struct.unpack('!LH', data[1:7])
+        (length, nb_fields) = struct.unpack_from('!LH', data, 1)
         self._check_message_length(data, length)
-        ndata = data[7:]
+        cur = 7
         ret = []
         if nb_fields > 0:
             pos = 0
             while pos < nb_fields:
-                eop = ndata.index(b'\x00')
-                name = ndata[0:eop].decode()
-                ndata = ndata[eop+1:]
+                eop = data.index(b'\x00', cur)
+                name = data[cur:eop].decode()
                 (table_oid, col_oid, type_oid, type_size, typmod, format_code)\
-                    = struct.unpack('!LhLhlh', ndata[0:18])
-                ndata = ndata[18:]
+                    = struct.unpack_from('!LhLhlh', data, eop + 1)
+                cur = eop + 19
                 ret.append({
                     'name': name,
                     'table_oid': table_oid,
@@ -275,26 +447,26 @@ class protocol3(object):
                 pos += 1
         return (data[0:1], ret)
 
-    def parse_data_row(self, data):
+    def parse_data_row(self, data, raw=False):
         """
-        DataRow parser.
+        DataRow parser. With raw, values are not decoded, as needed for
+        binary format.
         """
-        (length, nb_fields) = struct.unpack('!LH', data[1:7])
+        (length, nb_fields) = _data_row_header.unpack_from(data, 1)
         self._check_message_length(data, length)
+        unpack_from = _column_length.unpack_from
         ret = []
-        if nb_fields > 0:
-            pos = 0
-            cur = 7
-            while pos < nb_fields:
-                col_length = struct.unpack('!l', data[cur:cur+4])[0]
-                cur += 4
-                if col_length > 0:
-                    value = data[cur:cur+col_length].decode()
-                    cur += col_length
-                else:
-                    value = None
-                ret.append(value)
-                pos += 1
+        append = ret.append
+        cur = 7
+        for _ in range(nb_fields):
+            col_length = unpack_from(data, cur)[0]
+            cur += 4
+            if col_length > 0:
+                value = data[cur:cur + col_length]
+                append(value if raw else value.decode())
+                cur += col_length
+            else:
+                append(None)
         return (data[0:1], ret)
 
     def parse_command_complete(self, data):
@@ -328,14 +500,8 @@ class protocol3(object):
         """
         length = struct.unpack('!L', data[1:5])[0]
         self._check_message_length(data, length)
-        n_col = struct.unpack('!H', data[6:8])[0]
-        ret = []
-        pos = 0
-        ndata = data[8:]
-        while pos < n_col:
-            ret.append(struct.unpack('!H', ndata[0:2])[0])
-            ndata = ndata[2:]
-            pos += 1
+        n_col = struct.unpack_from('!H', data, 6)[0]
+        ret = list(struct.unpack_from('!%dH' % n_col, data, 8))
         return (data[0:1], ret)
 
     def parse_copy_data(self, data):
@@ -353,6 +519,75 @@ class protocol3(object):
     def parse_copy_both_response(self, data):
         return self.parse_copy_out_response(data)
 
+    def parse_copy_csv_row(self, data):
+        """
+        Parse a row of COPY CSV output. Unquoted empty values are NULL.
+        """
+        end = len(data)
+        if data[end - 1:end] == b'\n':
+            end -= 1
+        ret = []
+        pos = 0
+        while True:
+            if data[pos:pos + 1] == b'"':
+                # Quoted value, quotes are doubled inside.
+                parts = []
+                pos += 1
+                while True:
+                    quote = data.find(b'"', pos, end)
+                    if quote == -1:
+                        raise perror("Unterminated quoted CSV value.")
+                    parts.append(data[pos:quote])
+                    pos = quote + 1
+                    if data[pos:pos + 1] != b'"':
+                        break
+                    parts.append(b'"')
+                    pos += 1
+                ret.append(b''.join(parts).decode())
+            else:
+                comma = data.find(b',', pos, end)
+                if comma == -1:
+                    comma = end
+                ret.append(data[pos:comma].decode() if comma > pos else None)
+                pos = comma
+            if pos >= end:
+                break
+            if data[pos:pos + 1] != b',':
+                raise perror("Unvalid CSV row.")
+            pos += 1
+        return tuple(ret)
+
+    def parse_copy_binary_row(self, data):
+        """
+        Parse a row of COPY binary output, skipping the file header if
+        present. Values are left raw. Returns None for the file trailer.
+        """
+        pos = 0
+        if data[0:11] == _copy_binary_signature:
+            # Signature, flags and header extension.
+            ext_length = struct.unpack_from('!L', data, 15)[0]
+            pos = 19 + ext_length
+            if pos == len(data):
+                return None
+        nb_fields = struct.unpack_from('!h', data, pos)[0]
+        if nb_fields == -1:
+            return None
+        pos += 2
+        unpack_from = _column_length.unpack_from
+        ret = []
+        append = ret.append
+        for _ in range(nb_fields):
+            col_length = unpack_from(data, pos)[0]
+            pos += 4
+            if col_length < 0:
+                append(None)
+            else:
+                append(data[pos:pos + col_length])
+                pos += col_length
+        if pos != len(data):
+            raise perror("Unvalid binary COPY row.")
+        return tuple(ret)
+
     def is_error(self, typ):
         """
         Is an error message ?
@@ -446,6 +681,12 @@ class protocol3(object):
         """
         return typ == b'c'
 
+    def is_notification(self, typ):
+        """
+        Is a NotificationResponse message ?
+        """
+        return typ == b'A'
+
     def get_salt(self, message):
         """
         Get salt value from the first authentication message
@@ -460,55 +701,114 @@ class protocol3(object):
         """
         return [b'n', b'I', b'E', b'Z', b'R']
 
+    def get_query_eop_tags(self,):
+        """
+        Return a tag list corresponding to messages ending a simple query:
+        ReadyForQuery, which follows errors too, or CopyInResponse and
+        CopyBothResponse, waiting for the frontend.
+        """
+        return [b'Z', b'G', b'W']
+
+    def get_sync_eop_tags(self,):
+        """
+        Return a tag list corresponding to the message ending an extended
+        query cycle: ReadyForQuery. Errors are followed by ReadyForQuery too.
+        """
+        return [b'Z']
+
 
 class message_buffer(object):
     """
     Message buffer class.
+    Data is received in place at the end of a growable bytearray, and
+    messages are sliced out of it through memoryviews: each message is copied
+    once, whatever the number of reads it took to receive it.
     """
+    # Initial capacity, and capacity restored on truncate.
+    _default_size = 8192
+
     def __init__(self,):
-        self._bio = BytesIO()
+        self._buf = bytearray(self._default_size)
+        # Offset of the first message not yet consumed by
+        # get_messages_stream().
+        self._start = 0
+        # End of received data.
+        self._end = 0
+        # Offset of the next message header to check for EOP.
         self._pos = 0
 
+    def _reserve(self, size):
+        """
+        Make room for size bytes at the end of the buffer.
+        """
+        if self._end + size <= len(self._buf):
+            return
+        if self._start:
+            # Move the pending data to the front.
+            length = self._end - self._start
+            self._buf[0:length] = self._buf[self._start:self._end]
+            self._pos = max(self._pos - self._start, 0)
+            self._start, self._end = 0, length
+        if self._end + size > len(self._buf):
+            self._buf.extend(bytearray(
+                max(len(self._buf), self._end + size - len(self._buf))))
+
     def write(self, data):
         """
         Write data at the end of the buffer.
         """
-        self._bio.seek(0, 2)
-        self._bio.write(data)
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def recv_into(self, sock, size):
+        """
+        Receive at most size bytes from sock at the end of the buffer.
+        Returns the number of bytes received.
+        """
+        self._reserve(size)
+        length = sock.recv_into(
+            memoryview(self._buf)[self._end:self._end + size], size)
+        self._end += length
+        return length
 
     def truncate(self,):
         """
-        Truncate the buffer.
+        Truncate the buffer, keeping data received after the messages
+        already read, like the beginning of an asynchronous message.
         """
-        self._bio.truncate(0)
-        self._bio.seek(0)
+        tail = self._buf[max(self._start, self._pos):self._end]
+        if len(self._buf) > 16 * self._default_size:
+            # Don't keep the memory of a large result set.
+            self._buf = bytearray(self._default_size)
+        self._buf[0:len(tail)] = tail
+        self._start = 0
+        self._end = len(tail)
         self._pos = 0
 
+    def _next_message(self, pos):
+        """
+        Return the end offset of the message starting at pos, or None if
+        the message is not completely received.
+        """
+        if pos + 5 > self._end:
+            return None
+        length = struct.unpack_from('!L', self._buf, pos + 1)[0]
+        if pos + length + 1 > self._end:
+            return None
+        return pos + length + 1
+
     def get_messages(self,):
         """
-        Fetch messages with a generator.
+        Fetch complete messages with a generator, without consuming them.
         """
-        pos = 0
-        # Need to know the buffer length.
-        self._bio.seek(0, 2)
-        buf_len = self._bio.tell()
-        # If empty, nothing to do.
-        if buf_len == 0:
-            raise StopIteration
-
-        self._bio.seek(pos)
-        while pos < buf_len:
-            # Read message header: the first 5 bytes
-            header = self._bio.read(5)
-            if len(header) < 5:
-                raise perror("Unvalid message from buffer")
-            # Get message length from the header.
-            length = struct.unpack('!L', header[1:5])[0]
-            pos += length + 1
-            if pos > buf_len:
-                raise perror("Unvalid message from buffer")
-            body = self._bio.read(length - 4)
-            yield header + body
+        pos = self._start
+        while pos < self._end:
+            end = self._next_message(pos)
+            if end is None:
+                break
+            yield memoryview(self._buf)[pos:end].tobytes()
+            pos = end
 
     def get_messages_stream(self,):
         """
@@ -516,58 +816,214 @@ class message_buffer(object):
         message is not complete. This method has to be used when we don't
         want to bufferize all messages received before parsing them.
         """
-        pos_eom = 0
-        # Need to know the buffer length.
-        self._bio.seek(0, 2)
-        buf_len = self._bio.tell()
-        if buf_len == 0:
-            raise StopIteration
-
-        self._bio.seek(0)
-        while pos_eom < buf_len:
-            # Read message header: the first 5 bytes
-            header = self._bio.read(5)
-            if len(header) < 5:
-                self.truncate()
-                self.write(header)
-                raise StopIteration
-            # Get message length from the header.
-            length = struct.unpack('!L', header[1:5])[0]
-            pos_eom += length + 1
-            if pos_eom > buf_len:
-                body = self._bio.read(buf_len - self._bio.tell())
-                self.truncate()
-                self.write(header + body)
-                raise StopIteration
-            body = self._bio.read(length - 4)
-            yield header + body
-        if pos_eom == buf_len:
+        while self._start < self._end:
+            end = self._next_message(self._start)
+            if end is None:
+                # Keep incomplete message for the next read.
+                break
+            message = memoryview(self._buf)[self._start:end].tobytes()
+            self._start = end
+            yield message
+        if self._start == self._end:
             self.truncate()
 
     def is_eop(self, eop_msg_tags):
         """
         Will walk through the message buffer and looking for an EOP
-        (End Of Packet) message.
-        """
-        pos = self._pos
-        self._bio.seek(0, 2)
-        buf_len = self._bio.tell()
-        if buf_len == 0:
-            return False
-        while pos < buf_len:
-            self._bio.seek(pos)
-            header = self._bio.read(5)
-            if len(header) < 5:
-                return False
-            length = struct.unpack('!L', header[1:5])[0]
-            pos += length + 1
-            if pos > buf_len:
-                return False
-            else:
-                self._pos = pos
-            if header[0:1] in eop_msg_tags:
-                return True
-        return False
+        (End Of Packet) message. Complete messages received after it, like
+        notifications, are walked through too.
+        """
+        pos = max(self._pos, self._start)
+        eop = False
+        while pos < self._end:
+            end = self._next_message(pos)
+            if end is None:
+                break
+            if bytes(self._buf[pos:pos + 1]) in eop_msg_tags:
+                eop = True
+            pos = end
+        self._pos = pos
+        return eop
+
+
+def _to_int(value):
+    # Convert PG int2, int4 and int8 to python int()
+    try:
+        return int(value)
+    except Exception:
+        return None
+
+
+def _to_float(value):
+    # Convert PG float4, float8 and numeric to python float()
+    try:
+        return float(value)
+    except Exception:
+        return None
+
+
+def _to_bool(value):
+    # Convert PG boolean to python's
+    if value is None:
+        return None
+    return value == 't'
+
+
+def _from_text(convert=None):
+    # Decode a raw text value before converting it.
+    def decode(value):
+        if value is not None:
+            value = value.decode()
+        return convert(value) if convert else value
+    return decode
+
+
+def _from_binary(fmt):
+    # Unpack a binary value with a precompiled struct.
+    unpack = struct.Struct(fmt).unpack
+
+    def convert(value):
+        if value is None:
+            return None
+        return unpack(value)[0]
+    return convert
+
+
+class _utc(datetime.tzinfo):
+    """
+    UTC time zone.
+    """
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return 'UTC'
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
+_pg_epoch = datetime.datetime(2000, 1, 1, tzinfo=_utc())
+_int8 = _from_binary('!q')
+
+
+def _timestamptz(value):
+    # Binary timestamptz, as microseconds since 2000-01-01 UTC.
+    usecs = _int8(value)
+    if usecs is None:
+        return None
+    if usecs == 0x7FFFFFFFFFFFFFFF:
+        return datetime.datetime.max.replace(tzinfo=_pg_epoch.tzinfo)
+    if usecs == -0x8000000000000000:
+        return datetime.datetime.min.replace(tzinfo=_pg_epoch.tzinfo)
+    return _pg_epoch + datetime.timedelta(microseconds=usecs)
+
+
+class row_decoder(object):
+    """
+    DataRow decoder, compiled once per RowDescription: column names and
+    converters are resolved before decoding the first row.
+    """
+    # Converters by (type oid, format code).
+    converters = {
+        (20, 0): _to_int,
+        (21, 0): _to_int,
+        (23, 0): _to_int,
+        (700, 0): _to_float,
+        (701, 0): _to_float,
+        (1700, 0): _to_float,
+        (16, 0): _to_bool,
+        (20, 1): _int8,
+        (21, 1): _from_binary('!h'),
+        (23, 1): _from_binary('!i'),
+        (700, 1): _from_binary('!f'),
+        (701, 1): _from_binary('!d'),
+        (16, 1): _from_binary('!?'),
+        (1184, 1): _timestamptz,
+    }
+
+    def __init__(self, row_desc, parse_data_row):
+        self.parse = parse_data_row
+        self.names = tuple(col['name'] for col in row_desc)
+        # Binary values must not be decoded as text by the parser.
+        self.raw = any(col['format_code'] == 1 for col in row_desc)
+        # With duplicate names, the last column wins.
+        last = dict((name, i) for i, name in enumerate(self.names))
+        conversions = []
+        for i, col in enumerate(row_desc):
+            if last[col['name']] != i:
+                continue
+            convert = self._get_converter(col)
+            if convert:
+                conversions.append((i, col['name'], convert))
+        self.conversions = tuple(conversions)
+
+    def _get_converter(self, col):
+        convert = self.converters.get((col['type_oid'], col['format_code']))
+        if self.raw and col['format_code'] == 0:
+            convert = _from_text(convert)
+        return convert
+
+    def __call__(self, data):
+        values = self.parse(data, self.raw)[1]
+        row = dict(zip(self.names, values))
+        for i, name, convert in self.conversions:
+            row[name] = convert(values[i])
+        return row
+
+
+class tuple_row_decoder(row_decoder):
+    """
+    DataRow decoder building plain tuples, values in columns order.
+    """
+
+    def __init__(self, row_desc, parse_data_row):
+        super(tuple_row_decoder, self).__init__(row_desc, parse_data_row)
+        conversions = []
+        for i, col in enumerate(row_desc):
+            convert = self._get_converter(col)
+            if convert:
+                conversions.append((i, convert))
+        self.conversions = tuple(conversions)
+
+    def __call__(self, data):
+        values = self.parse(data, self.raw)[1]
+        for i, convert in self.conversions:
+            values[i] = convert(values[i])
+        return tuple(values)
+
+
+class namedtuple_row_decoder(tuple_row_decoder):
+    """
+    DataRow decoder building named tuples, the class being created once per
+    RowDescription. Invalid or duplicate column names are replaced by
+    positional names, like _1.
+    """
+
+    def __init__(self, row_desc, parse_data_row):
+        super(namedtuple_row_decoder, self).__init__(row_desc, parse_data_row)
+        fields = []
+        for name in self.names:
+            try:
+                fields.append(str(name))
+            except UnicodeError:
+                fields.append('_')
+        self.row_class = namedtuple('Row', fields, rename=True)
+
+    def __call__(self, data):
+        values = self.parse(data, self.raw)[1]
+        for i, convert in self.conversions:
+            values[i] = convert(values[i])
+        # Like row_class._make(), without checking the length again.
+        return tuple.__new__(self.row_class, values)
+
+
+# Row decoders by row factory name.
+row_decoders = {
+    'dict': row_decoder,
+    'tuple': tuple_row_decoder,
+    'namedtuple': namedtuple_row_decoder,
+}
 
 
 class connector(object):
@@ -582,7 +1038,8 @@ class connector(object):
             user,
             password='',
             database='',
-            use_ssl=True):
+            use_ssl=True,
+            connect_timeout=10):
         # Connection parameters.
         self._host = host
         self._port = port
@@ -602,12 +1059,17 @@ class connector(object):
         self._protocol = protocol3()
         # message_buffer instance.
         self._message_buffer = message_buffer()
-        # Size in bytes to read at each socket.recv() call.
+        # Size in bytes to read at each socket.recv_into() call, adapted
+        # between min and max.
         self._socket_read_length = 2048
+        self._socket_read_min = 2048
+        self._socket_read_max = 1024 * 1024
         # Is the authentication phase done ?
         self._is_auth = False
         # Is the backend ready for query ?
         self._is_backend_ready = False
+        # Transaction status from the last ReadyForQuery message.
+        self._transaction_status = None
         # Backend key.
         self._backend_key = None
         # Backend PID.
@@ -622,67 +1084,143 @@ class connector(object):
         self._nb_rows = None
         # Socket default timeout.
         self._default_timeout = 60  # Seconds
+        # Time allowed to establish the connection.
+        self._connect_timeout = connect_timeout  # Seconds
+        # Delay before trying the next address if the previous attempt is
+        # not established yet.
+        self._connect_attempt_delay = 0.25  # Seconds
+        # TCP keepalive: idle time before probing, interval between probes
+        # and number of unanswered probes before dropping the connection.
+        self._keepalives_idle = 60  # Seconds
+        self._keepalives_interval = 10  # Seconds
+        self._keepalives_count = 3
         # PostgreSQL version
         self._pg_version = 0
         # replication
         self._replication = False
+        # Named prepared statements by query, least recently used first.
+        self._statements = OrderedDict()
+        # Maximum number of prepared statements kept on the backend.
+        self._statements_max = 64
+        # Prepared statements counter, used to name them.
+        self._statements_seq = 0
+        # Row decoders by RowDescription.
+        self._decoders = {}
+        # Types requested in binary format for prepared statements: those
+        # decoded to the same Python values as in text format. float4 would
+        # lose its text rounding, and timestamptz is returned as text.
+        # float8 is only added from PostgreSQL 12, see _get_result_formats().
+        self._binary_result_types = frozenset([20, 21, 23, 16])
+        # Seconds spent to connect and authenticate.
+        self._connect_time = None
+        # Name of the agent part using the connection, for statistics.
+        self._subsystem = None
+        # Requests sent and bytes received, for statistics.
+        self._round_trips = 0
+        self._bytes_received = 0
+        # Asynchronous notifications received, not yet returned by
+        # wait_notify().
+        self._notifications = []
 
     def _set_ip_type(self,):
         """
         Convert the given hostname into a more convenient form.
         """
-        # ip4
-        if re.match(r'(?:[3-9]\d?|2(?:5[0-5]|[0-4]?\d)?|1\d{0,2}|\d)'
-                    '(\.(?:[3-9]\d?|2(?:5[0-5]|[0-4]?\d)?|1\d{0,2}|\d)){3}$',
-                    self._host):
-            self._host_ip4 = self._host
-        # ip6
-        elif re.match(r'^[0-9a-fA-F]+:([0-9a-fA-F]*:*){0,6}:[0-9a-fA-F]+$',
-                      self._host):
-            self._host_ip6 = self._host
-        # unix socket
-        elif re.match(r'^\/.*', self._host):
-            self._host_unix = self._host
-        # hostname
-        else:
-            try:
-                for addr in socket.getaddrinfo(self._host,
-                                               self._port,
-                                               socket.AF_UNSPEC,
-                                               socket.SOCK_STREAM):
-                    if addr[0] == socket.AF_INET:
-                        self._host_ip4 = addr[4][0]
-                    if addr[0] == socket.AF_INET6:
-                        self._host_ip6 = addr[4][0]
-            except socket.gaierror:
-                raise error('PGC404', 'FATAL', "Unknown name or service"
-                            " '{host}'".format(host=self._host))
-
-    def _socket_read(self,):
+        self._host_ip4, self._host_ip6, self._host_unix = _resolve(
+            self._host, self._port)
+
+    def _socket_recv(self,):
+        """
+        Read some data from the socket, in place at the end of the buffer.
+        """
+        try:
+            length = self._message_buffer.recv_into(
+                self._socket, self._socket_read_length)
+        except socket.timeout as err:
+            raise error('PGC105', 'FATAL', "Timeout")
+        except socket.error as err:
+            raise error('PGC106', 'FATAL', "Socket error: {msg}".format(
+                                                                msg=err))
+        if not length:
+            raise error('PGC106', 'FATAL', "Socket error: connection closed")
+        self._bytes_received += length
+        # Adapt read size: grow while reads fill it, shrink back on small
+        # responses.
+        if length == self._socket_read_length:
+            self._socket_read_length = min(
+                self._socket_read_length * 2, self._socket_read_max)
+        elif length < self._socket_read_length // 4:
+            self._socket_read_length = max(
+                self._socket_read_length // 2, self._socket_read_min)
+
+    def _socket_read(self, eop_tags=None, timeout=None):
         """
         Read (from the socket), write (into the buffer)
+        Once timeout is elapsed, the running query is cancelled and its
+        response drained, the backend reporting the cancellation.
         """
+        if eop_tags is None:
+            eop_tags = self._protocol.get_eop_tags()
         self._message_buffer.truncate()
-        while not self._message_buffer.is_eop(self._protocol.get_eop_tags()):
-            try:
-                raw_data = self._socket.recv(self._socket_read_length)
-            except socket.timeout as err:
-                raise error('PGC105', 'FATAL', "Timeout")
-            except socket.error as err:
-                raise error('PGC106', 'FATAL', "Socket error: {msg}".format(
-                                                                    msg=err))
-            self._message_buffer.write(raw_data)
+        if timeout is None:
+            while not self._message_buffer.is_eop(eop_tags):
+                self._socket_recv()
+            return
+
+        socket_timeout = self._socket.gettimeout()
+        deadline = time.time() + timeout
+        try:
+            while not self._message_buffer.is_eop(eop_tags):
+                if deadline is None:
+                    self._socket_recv()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    deadline = None
+                    self._socket.settimeout(socket_timeout)
+                    self.cancel()
+                    continue
+                self._socket.settimeout(
+                    remaining if socket_timeout is None
+                    else min(remaining, socket_timeout))
+                try:
+                    self._socket_recv()
+                except error as err:
+                    # Let the socket timeout raise if shorter than deadline.
+                    if err.code != 'PGC105' or time.time() < deadline:
+                        raise
+        finally:
+            self._socket.settimeout(socket_timeout)
+
+    def _socket_stream(self,):
+        """
+        Read and yield raw messages as soon as they are received, up to
+        ReadyForQuery. Only incomplete messages are kept in the buffer.
+        """
+        self._message_buffer.truncate()
+        while True:
+            self._socket_recv()
+            for raw in self._message_buffer.get_messages_stream():
+                yield raw
+                if self._protocol.is_ready_for_query(raw[0:1]):
+                    return
 
     def _get_messages(self, method):
         """
         Read and parse messages from the buffer.
         """
         for raw in method():
-            try:
-                yield self._protocol.parse_message(raw)
-            except perror as err:
-                raise error('PGC107', 'FATAL', "Protocol violation: "
-                                               "{msg}".format(msg=err.message))
+            yield self._parse_message(raw)
+
+    def _parse_message(self, raw):
+        """
+        Parse a message.
+        """
+        try:
+            return self._protocol.parse_message(raw)
+        except perror as err:
+            raise error('PGC107', 'FATAL', "Protocol violation: "
+                                           "{msg}".format(msg=err.message))
 
     def _check_message_error(self, message):
         """
@@ -705,7 +1243,6 @@ class connector(object):
         """
         Create a new socket.
         """
-        tmp_socket = None
         # Convert "host" parameter to a valid socket address
         self._set_ip_type()
         if self._host_unix is None \
@@ -718,35 +1255,84 @@ class connector(object):
         if self._host_unix is not None:
             try:
                 tmp_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                tmp_socket.settimeout(self._connect_timeout)
                 tmp_socket.connect(self._host_unix + '/.s.PGSQL.'
                                    + str(self._port))
-                return tmp_socket
             except socket.error:
                 raise error('PGC101', 'FATAL', "Could not connect to "
                                                "{host}".format(
                                                    host=self._host_unix))
-        # Try with IPV4
-        if self._host_ip4 is not None:
-            try:
-                tmp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                tmp_socket.connect((self._host_ip4, self._port))
-                return tmp_socket
-            except socket.error:
-                if self._host_ip6 is None:
-                    raise error('PGC101', 'FATAL', "Could not connect to "
-                                                   "{host}".format(
-                                                        host=self._host_ip4))
-
-        # Try with IPV6
-        if self._host_ip6 is not None:
-            try:
-                tmp_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-                tmp_socket.connect((self._host_ip6, self._port))
-                return tmp_socket
-            except socket.error:
-                raise error('PGC101', 'FATAL', "Could not connect to "
-                                               "{host}".format(
-                                                   host=self._host_ip6))
+        else:
+            # Try with IPV4 and IPV6
+            addresses = []
+            if self._host_ip4 is not None:
+                addresses.append((socket.AF_INET, self._host_ip4))
+            if self._host_ip6 is not None:
+                addresses.append((socket.AF_INET6, self._host_ip6))
+            tmp_socket = self._connect_tcp(addresses)
+            self._set_keepalive(tmp_socket)
+        # Bound SSL negotiation and startup too.
+        tmp_socket.settimeout(self._default_timeout)
+        return tmp_socket
+
+    def _connect_tcp(self, addresses):
+        """
+        Connect to the first address accepting the connection. Like Happy
+        Eyeballs, the next address is tried without waiting for a
+        previous attempt to fail, after a short delay.
+        """
+        deadline = time.time() + self._connect_timeout
+        pending = {}
+        next_attempt = 0
+        try:
+            while addresses or pending:
+                now = time.time()
+                if now >= deadline:
+                    break
+                if addresses and now >= next_attempt:
+                    family, host = addresses.pop(0)
+                    tmp_socket = socket.socket(family, socket.SOCK_STREAM)
+                    tmp_socket.setblocking(0)
+                    res = tmp_socket.connect_ex((host, self._port))
+                    if res not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        # Failed at once, try the next address now.
+                        tmp_socket.close()
+                        continue
+                    pending[tmp_socket] = host
+                    next_attempt = now + self._connect_attempt_delay
+
+                timeout = deadline - now
+                if addresses:
+                    timeout = min(timeout, max(next_attempt - now, 0))
+                _, writable, _ = select.select([], list(pending), [], timeout)
+                for tmp_socket in writable:
+                    del pending[tmp_socket]
+                    res = tmp_socket.getsockopt(
+                        socket.SOL_SOCKET, socket.SO_ERROR)
+                    if res == 0:
+                        tmp_socket.setblocking(1)
+                        return tmp_socket
+                    tmp_socket.close()
+                    next_attempt = 0
+        finally:
+            for tmp_socket in pending:
+                tmp_socket.close()
+        raise error('PGC101', 'FATAL', "Could not connect to "
+                                       "{host}".format(host=self._host))
+
+    def _set_keepalive(self, tmp_socket):
+        """
+        Enable TCP keepalive, to detect dead servers and network failures.
+        """
+        tmp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Tuning is not portable.
+        for option, value in (
+                ('TCP_KEEPIDLE', self._keepalives_idle),
+                ('TCP_KEEPINTVL', self._keepalives_interval),
+                ('TCP_KEEPCNT', self._keepalives_count)):
+            if hasattr(socket, option):
+                tmp_socket.setsockopt(
+                    socket.IPPROTO_TCP, getattr(socket, option), value)
 
     def _socket_send(self, data):
         """
@@ -755,19 +1341,21 @@ class connector(object):
         length = self._socket.send(data)
         if length != len(data):
             raise error('PGC106', 'FATAL', "Could not send all data.")
+        self._round_trips += 1
 
     def _wrap_ssl_socket(self, tmp_socket,):
         """
         Wrap the socket with SSL layer.
         """
-        if self._ssl is True:
+        # PostgreSQL never accepts SSL over Unix sockets.
+        if self._ssl is True and self._host_unix is None:
             data = self._protocol.ssl_request()
             tmp_socket.send(data)
             res = tmp_socket.recv(self._socket_read_length)
             if self._protocol.is_error(res[0]):
                 raise error('PGC103', 'FATAL', "SSL error")
             if self._protocol.parse_ssl_response(res):
-                self._socket = ssl.wrap_socket(tmp_socket)
+                self._socket = _wrap_ssl(tmp_socket)
             else:
                 self._socket = tmp_socket
         else:
@@ -795,10 +1383,47 @@ class connector(object):
                 version = int(version) * 100
             self._pg_version = int(version)
 
+    @contextmanager
+    def _instrument(self, operation, query=None):
+        """
+        Measure an operation and report its statistics to hooks.
+        """
+        stats = {
+            'operation': operation,
+            'query': query,
+            'subsystem': self._subsystem,
+            'rows': 0,
+            'error': None,
+        }
+        start = time.time()
+        round_trips = self._round_trips
+        bytes_received = self._bytes_received
+        try:
+            yield stats
+        except error as err:
+            stats['error'] = err.code
+            raise
+        finally:
+            if _hooks:
+                stats['duration'] = time.time() - start
+                stats['round_trips'] = self._round_trips - round_trips
+                stats['bytes_received'] = \
+                    self._bytes_received - bytes_received
+                for hook in _hooks:
+                    hook(stats)
+
     def connect(self,):
         """
         Connect to the database.
         """
+        with self._instrument('connect'):
+            self._connect()
+
+    def _connect(self,):
+        """
+        Open the connection, negotiate SSL and authenticate.
+        """
+        start = time.time()
         # Create and connect a new socket
         tmp_socket = self._create_new_socket()
         # Wrap with SSL
@@ -855,11 +1480,36 @@ class connector(object):
                 self._backend_pid = message[1]['pid']
             elif self._protocol.is_ready_for_query(message[0]):
                 self._is_backend_ready = True
+                self._transaction_status = message[1]['status']
         # Ultimate check.
         if not self._is_auth:
             raise error('PGC103', 'FATAL', "Unable to connect.")
         if not self._is_backend_ready:
             raise error('PGC104', 'FATAL', "Backend not ready.")
+        self._connect_time = time.time() - start
+
+    def cancel(self,):
+        """
+        Cancel the query running on this connection. This opens a new
+        connection to send a CancelRequest, and may be called from another
+        thread. The cancelled query fails with a query_canceled error.
+        """
+        if self._backend_pid is None:
+            # Not connected.
+            return
+        data = self._protocol.cancel_request(
+            self._backend_pid, self._backend_key)
+        tmp_socket = self._create_new_socket()
+        try:
+            tmp_socket.settimeout(self._default_timeout)
+            tmp_socket.sendall(data)
+            # The backend closes the connection once the request is handled.
+            tmp_socket.recv(1)
+        except socket.error as err:
+            raise error('PGC106', 'FATAL', "Socket error: {msg}".format(
+                                                                msg=err))
+        finally:
+            tmp_socket.close()
 
     def close(self,):
         """
@@ -869,39 +1519,306 @@ class connector(object):
         self._socket_send(data)
         self._socket.close()
 
-    def execute(self, query, parameters=None):
+    def execute(self, query, parameters=None, prepare=False, timeout=None):
         """
         Execute a query and fetch the results.
+        With parameters or prepare, the query is run as a named prepared
+        statement using the extended query protocol, and parameters are bound.
+        Matching pattern for parameters is '%s'.
+        A query running longer than timeout seconds is cancelled.
+        """
+        self._query = query
+        self._rows = []
+        self._nb_rows = None
+        with self._instrument('execute', query) as stats:
+            if parameters or prepare:
+                self._execute_prepared(query, parameters or (), timeout)
+            else:
+                data = self._protocol.query(self._query)
+                self._socket_send(data)
+                self._socket_read(
+                    self._protocol.get_query_eop_tags(), timeout)
+            stats['rows'] = self.get_nb_rows()
+
+    def execute_iter(
+            self, query, parameters=None, prepare=False, row_factory='dict'):
+        """
+        Execute a query and yield rows as soon as they are received, without
+        buffering the whole result set. The query is sent when iteration
+        starts. get_rows() is not available for such a query, get_nb_rows()
+        is once iteration is over. Rows are built like with get_rows().
+        """
+        self._query = query
+        self._rows = []
+        self._nb_rows = None
+        with self._instrument('execute', query) as stats:
+            if parameters or prepare:
+                statement = self._send_prepared(query, parameters or ())
+            else:
+                self._socket_send(self._protocol.query(self._query))
+                statement = None
+
+            messages = self._socket_stream()
+            rows = 0
+            try:
+                for row in self._get_result(messages, statement, row_factory):
+                    rows += 1
+                    yield row
+            finally:
+                stats['rows'] = rows
+                # Drain the rest of the result if the caller stopped early.
+                for raw in messages:
+                    pass
+
+    def copy_out(self, query, format='csv', types=None):
+        """
+        Run a SELECT query through COPY TO STDOUT and yield rows as tuples,
+        as soon as they are received. With csv format, values are strings.
+        With binary format, values are bytes, unless the type oids of the
+        columns are given to decode them.
+        """
+        if format == 'csv':
+            parse = self._protocol.parse_copy_csv_row
+        elif format == 'binary':
+            parse = self._protocol.parse_copy_binary_row
+            if types is not None:
+                parse = self._copy_binary_decoder(types)
+        else:
+            raise error('PGC109', 'ERROR',
+                        "Unsupported COPY format '%s'." % format)
+
+        self._query = "COPY (%s) TO STDOUT WITH (FORMAT %s)" % (query, format)
+        self._rows = []
+        self._nb_rows = None
+        with self._instrument('copy_out', self._query) as stats:
+            self._socket_send(self._protocol.query(self._query))
+
+            messages = self._socket_stream()
+            err = None
+            rows = 0
+            try:
+                for raw in messages:
+                    if self._protocol.is_copy_data(raw[0:1]):
+                        row = self._decode_row(
+                            parse, self._protocol.parse_copy_data(raw)[1])
+                        if row is not None:
+                            rows += 1
+                            yield row
+                        continue
+
+                    message = self._parse_message(raw)
+                    if self._protocol.is_error(message[0]):
+                        err = err or message
+                    elif not self._protocol.is_copy_out_response(message[0]):
+                        self._handle_message(message)
+            finally:
+                stats['rows'] = rows
+                # Drain the rest of the result if the caller stopped early.
+                for raw in messages:
+                    pass
+            if err:
+                self._check_message_error(err)
+
+    def _copy_binary_decoder(self, types):
+        """
+        Build a parser of binary COPY rows converting values by type oid.
+        Values of unknown types are decoded as text.
+        """
+        converters = tuple(
+            row_decoder.converters.get((oid, 1)) or _from_text()
+            for oid in types)
+        parse = self._protocol.parse_copy_binary_row
+
+        def decode(data):
+            values = parse(data)
+            if values is None:
+                return None
+            return tuple(
+                convert(value) for convert, value in zip(converters, values))
+        return decode
+
+    def _execute_prepared(self, query, parameters, timeout=None):
+        """
+        Parse (once per connection), bind and execute a query in a single
+        round trip.
+        """
+        statement = self._send_prepared(query, parameters)
+        self._socket_read(self._protocol.get_sync_eop_tags(), timeout)
+        self._learn_result(statement)
+
+    def _learn_result(self, statement):
+        """
+        Learn a statement from the buffered response, once.
+        """
+        if statement['formats'] is None:
+            for raw in self._message_buffer.get_messages():
+                if raw[0:1] in (b'1', b'T', b'n'):
+                    self._learn_statement(statement, self._parse_message(raw))
+
+    def _send_prepared(self, query, parameters):
+        """
+        Send Parse (if not yet prepared), Bind, Describe, Execute and Sync
+        messages. Returns the statement, to learn from the response.
+        """
+        data, statement = self._build_prepared(query, parameters)
+        self._socket_send(data + self._protocol.sync())
+        return statement
+
+    def _build_prepared(self, query, parameters):
+        """
+        Build Parse (if not yet prepared), Bind, Describe and Execute
+        messages. Returns them with the statement.
         """
         if parameters:
-            self._query = self._build_query(query, parameters)
+            # Placeholders are only rewritten along with parameters, like
+            # a query without parameters is sent as is by execute().
+            placeholders = []
+
+            def placeholder(match):
+                if match.group(1) == '%':
+                    return '%'
+                placeholders.append(match)
+                return '$%d' % len(placeholders)
+
+            query = re.sub(r'%([s%])', placeholder, query)
+            if len(placeholders) != len(parameters):
+                raise error('PGC110', 'ERROR',
+                            "Query has %d placeholders for %d parameters."
+                            % (len(placeholders), len(parameters)))
+        data = b''
+        statement = self._statements.pop(query, None)
+        if statement is None:
+            if len(self._statements) >= self._statements_max:
+                _, old = self._statements.popitem(last=False)
+                data += self._protocol.close('S', old['name'])
+            self._statements_seq += 1
+            statement = {
+                'query': query,
+                'name': 'spc_%d' % self._statements_seq,
+                # Result format codes, known after the first execution.
+                'formats': None,
+            }
+            data += self._protocol.parse(statement['name'], query)
         else:
-            self._query = query
+            # Move to the most recently used end.
+            self._statements[query] = statement
+        data += self._protocol.bind(
+            statement['name'], [self._encode_parameter(p) for p in parameters],
+            statement['formats'] or ())
+        data += self._protocol.describe('P')
+        data += self._protocol.execute()
+        return data, statement
+
+    def execute_batch(self, queries, timeout=None, row_factory='dict'):
+        """
+        Execute several queries in a single round trip and return the list of
+        their rows. Each query is either a string or a (query, parameters)
+        tuple. Queries are run as prepared statements within an implicit
+        transaction: an error aborts the whole batch, as does timeout. Rows
+        are built like with get_rows().
+        """
+        self._query = ';\n'.join(
+            query[0] if isinstance(query, tuple) else query
+            for query in queries)
         self._rows = []
         self._nb_rows = None
-        data = self._protocol.query(self._query)
-        self._socket_send(data)
-        self._socket_read()
-        self.get_nb_rows()
+        with self._instrument('execute', self._query) as stats:
+            results = self._execute_batch(queries, timeout, row_factory)
+            stats['rows'] = sum(len(rows) for rows in results)
+        return results
 
-    def _build_query(self, query, parameters):
+    def _execute_batch(self, queries, timeout, row_factory):
         """
-        Build a query using an input string and parameters (tuple).
-        Matching pattern for replacement is '%s'.
-        Supported types are: int, float, str, datetime.date, datetime.datetime.
+        Send queries of a batch and split their rows.
         """
-        pp = list()
-        for p in parameters:
-            if type(p) is str:
-                p = "'%s'" % (re.sub(r"('|\\)", r"\\\1", p))
-            elif type(p) in (datetime.date, datetime.datetime):
-                p = "'%s'" % (p)
-            elif type(p) in (int, float):
-                p = str(p)
+        data = b''
+        statements = []
+        for query in queries:
+            if isinstance(query, tuple):
+                query, parameters = query
             else:
-                raise Exception("Unsupported type %s." % (type(p)))
-            pp.append(p)
-        return query % tuple(pp)
+                parameters = ()
+            chunk, statement = self._build_prepared(query, parameters)
+            data += chunk
+            statements.append(statement)
+        self._socket_send(data + self._protocol.sync())
+        self._socket_read(self._protocol.get_sync_eop_tags(), timeout)
+
+        # Split messages in result sets, each ending with CommandComplete or
+        # EmptyQueryResponse.
+        results = []
+        rows = []
+        decode = self._decode_tuple
+        err = None
+        for raw in self._message_buffer.get_messages():
+            if self._protocol.is_data_row(raw[0:1]):
+                rows.append(self._decode_row(decode, raw))
+                continue
+
+            message = self._parse_message(raw)
+            if len(results) < len(statements):
+                self._learn_statement(statements[len(results)], message)
+            if self._protocol.is_row_description(message[0]):
+                decode = self._get_decoder(message[1], row_factory)
+            elif self._protocol.is_error(message[0]):
+                err = err or message
+            else:
+                self._handle_message(message)
+                if self._protocol.is_command_complete(message[0]) or \
+                        self._protocol.is_empty_query_response(message[0]):
+                    results.append(rows)
+                    rows = []
+                    decode = self._decode_tuple
+        if err:
+            self._check_message_error(err)
+        return results
+
+    def _learn_statement(self, statement, message):
+        """
+        Cache a statement once parsed: on error, backend aborts at the failing
+        message and skips up to Sync. Then choose result formats from the
+        columns types.
+        """
+        if message[0] == b'1':
+            self._statements[statement['query']] = statement
+        elif statement['formats'] is not None:
+            return
+        elif self._protocol.is_row_description(message[0]):
+            statement['formats'] = self._get_result_formats(message[1])
+        elif message[0] == b'n':
+            statement['formats'] = ()
+
+    def _get_result_formats(self, row_desc):
+        """
+        Request binary format for columns of _binary_result_types, text
+        otherwise.
+        """
+        binary = self._binary_result_types
+        if self._pg_version >= 120000:
+            # Before, float8 text output is rounded to 15 digits unless
+            # extra_float_digits is set.
+            binary = binary | frozenset([701])
+        formats = tuple(
+            1 if col['type_oid'] in binary else 0 for col in row_desc)
+        return formats if 1 in formats else ()
+
+    def _encode_parameter(self, value):
+        """
+        Encode a parameter in PostgreSQL text format.
+        """
+        if value is None:
+            return None
+        if isinstance(value, bool):
+            value = 't' if value else 'f'
+        elif isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.isoformat()
+        elif isinstance(value, float):
+            value = repr(value)
+        elif not isinstance(value, (bytes, type(u''))):
+            value = str(value)
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        return value
 
     def begin(self,):
         """
@@ -921,62 +1838,120 @@ class connector(object):
         """
         self.execute("ROLLBACK")
 
-    def get_rows(self,):
+    def get_rows(self, row_factory='dict'):
         """
-        Get rows stored in self._rows.
+        Get rows of the last query. Rows are dicts by default, or tuples or
+        named tuples with row_factory set to 'tuple' or 'namedtuple'.
         """
-        row_desc = None
-        for message in self._get_messages(self._message_buffer.get_messages):
+        with self._instrument('get_rows', self._query) as stats:
+            rows = 0
+            try:
+                for row in self._get_result(
+                        self._message_buffer.get_messages(),
+                        row_factory=row_factory, replay=True):
+                    rows += 1
+                    yield row
+            finally:
+                stats['rows'] = rows
+
+    def _get_result(
+            self, messages, statement=None, row_factory='dict', replay=False):
+        """
+        Parse raw messages of a query result and yield rows. A backend error
+        is raised at the end of the result. With replay, messages have been
+        handled already and notifications are not collected again.
+        """
+        # If don't have rows descriptions
+        # then store them as tuple.
+        decode = self._decode_tuple
+        err = None
+        for raw in messages:
+            if self._protocol.is_data_row(raw[0:1]):
+                yield self._decode_row(decode, raw)
+                continue
+
+            message = self._parse_message(raw)
             if self._protocol.is_row_description(message[0]):
-                row_desc = message[1]
-            elif self._protocol.is_data_row(message[0]):
-                if row_desc is not None:
-                    row = {}
-                    i = 0
-                    for value in message[1]:
-                        if row_desc[i]['type_oid'] in [20, 21, 23]:
-                            # Convert PG int2, int4 and int8 to python int()
-                            try:
-                                row[row_desc[i]['name']] = int(value)
-                            except Exception:
-                                row[row_desc[i]['name']] = None
-                        elif row_desc[i]['type_oid'] in [700, 701, 1700]:
-                            # Convert PG float4, float8 and numeric to python
-                            # float()
-                            try:
-                                row[row_desc[i]['name']] = float(value)
-                            except Exception:
-                                row[row_desc[i]['name']] = None
-                        elif row_desc[i]['type_oid'] == 16:
-                            # Convert PG boolean to python's
-                            if value == 't':
-                                row[row_desc[i]['name']] = True
-                            else:
-                                row[row_desc[i]['name']] = False
-                        else:
-                            row[row_desc[i]['name']] = value
-                        i += 1
-                else:
-                    # If don't have rows descriptions
-                    # then store them as tuple.
-                    row = tuple(message[1])
-                yield row
+                decode = self._get_decoder(message[1], row_factory)
             elif self._protocol.is_copy_data(message[0]):
                 yield message[1]
-            elif self._protocol.is_command_complete(message[0]):
-                self._nb_rows = message[1]['nb_rows']
-            elif self._protocol.is_empty_query_response(message[0]):
-                self._nb_rows = 0
-            else:
-                self._check_message_error(message)
+            elif self._protocol.is_error(message[0]):
+                err = err or message
+            elif not (replay and self._protocol.is_notification(message[0])):
+                self._handle_message(message)
+            if statement:
+                self._learn_statement(statement, message)
+        if err:
+            self._check_message_error(err)
+
+    def _decode_row(self, decode, data):
+        """
+        Decode a DataRow.
+        """
+        try:
+            return decode(data)
+        except perror as err:
+            raise error('PGC107', 'FATAL', "Protocol violation: "
+                                           "{msg}".format(msg=err.message))
+
+    def _decode_tuple(self, data):
+        """
+        Decode a DataRow without RowDescription.
+        """
+        return tuple(self._protocol.parse_data_row(data)[1])
+
+    def _handle_message(self, message):
+        """
+        Handle a message other than rows and their description.
+        """
+        if self._protocol.is_command_complete(message[0]):
+            self._command_complete(message)
+        elif self._protocol.is_empty_query_response(message[0]):
+            self._nb_rows = 0
+        elif self._protocol.is_ready_for_query(message[0]):
+            self._transaction_status = message[1]['status']
+        elif self._protocol.is_notification(message[0]):
+            self._notifications.append(message[1])
+        else:
+            self._check_message_error(message)
+
+    def _command_complete(self, message):
+        """
+        Handle a CommandComplete message.
+        """
+        self._nb_rows = message[1]['nb_rows']
+        if message[1]['command'].startswith(('DISCARD ALL', 'DEALLOCATE')):
+            # Prepared statements are gone.
+            self._statements.clear()
+
+    def _get_decoder(self, row_desc, row_factory='dict'):
+        """
+        Get the row decoder matching a RowDescription, compiling it once.
+        """
+        key = (row_factory,) + tuple(
+            (col['name'], col['type_oid'], col['format_code'])
+            for col in row_desc)
+        decode = self._decoders.get(key)
+        if decode is None:
+            if row_factory not in row_decoders:
+                raise error('PGC109', 'ERROR', "Unsupported row factory "
+                                               "'%s'." % row_factory)
+            if len(self._decoders) >= self._statements_max:
+                self._decoders.clear()
+            decode = self._decoders[key] = row_decoders[row_factory](
+                row_desc, self._protocol.parse_data_row)
+        return decode
 
     def get_nb_rows(self,):
         """
         Get number of rows affected by the current query.
         """
         if self._nb_rows is None:
-            for _ in self.get_rows():
-                pass
+            # Check the result without parsing nor decoding rows.
+            skip = (b'T', b'D', b'd')
+            for raw in self._message_buffer.get_messages():
+                if raw[0:1] not in skip:
+                    self._handle_message(self._parse_message(raw))
         return self._nb_rows
 
     def set_timeout(self, timeout):
@@ -991,8 +1966,168 @@ class connector(object):
         """
         return self._socket.gettimeout()
 
+    def set_subsystem(self, subsystem):
+        """
+        Set the name of the agent part using the connection, reported to
+        hooks.
+        """
+        self._subsystem = subsystem
+
+    def get_connect_time(self,):
+        """
+        Get the time spent, in seconds, to connect and authenticate.
+        """
+        return self._connect_time
+
+    def get_transaction_status(self,):
+        """
+        Get backend transaction status: 'I' when idle, 'T' when in a
+        transaction block, 'E' when in a failed transaction block.
+        """
+        return self._transaction_status
+
+    def fileno(self,):
+        """
+        Socket file descriptor, for select().
+        """
+        return self._socket.fileno()
+
+    def wait_notify(self, timeout=None):
+        """
+        Wait for notifications on channels listened to with LISTEN, at most
+        timeout seconds, or forever with None. Returns the notifications
+        received since the last call, oldest first, as dicts with pid,
+        channel and payload keys: an empty list once timeout is elapsed.
+        A timeout of 0 only checks without blocking, for connections
+        polled with select().
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            # Handle messages received after the last result.
+            self._message_buffer.truncate()
+            for raw in self._message_buffer.get_messages_stream():
+                self._handle_message(self._parse_message(raw))
+            if self._notifications:
+                break
+            # Data already decrypted by SSL does not make the socket readable.
+            pending = getattr(self._socket, 'pending', None)
+            if not (pending and pending()):
+                remaining = None
+                if deadline is not None:
+                    remaining = max(deadline - time.time(), 0)
+                readable = select.select([self._socket], [], [], remaining)[0]
+                if not readable:
+                    break
+            self._socket_recv()
+        notifications, self._notifications = self._notifications, []
+        return notifications
+
+    def is_alive(self,):
+        """
+        Check, without blocking, that the connection is still usable. An idle
+        backend never sends anything: readable data means the server closed
+        the connection or sent a FATAL error.
+        """
+        if self._socket is None:
+            return False
+        try:
+            readable, _, _ = select.select([self._socket], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
     def get_pg_version(self,):
         """
         Get PostgreSQL version.
         """
         return self._pg_version
+
+
+class async_connector(connector):
+    """
+    PostgreSQL connector running queries without blocking: a query is sent,
+    then the connection is polled each time its socket is readable, until
+    the result is complete. Many connections can be multiplexed from a
+    single thread with wait_all(). Connecting is still blocking.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(async_connector, self).__init__(*args, **kwargs)
+        self._pending = None
+
+    def send_query(self, query, parameters=None, prepare=False):
+        """
+        Send a query without waiting for its result. Parameters are bound
+        like with execute().
+        """
+        self._query = query
+        self._rows = []
+        self._nb_rows = None
+        self._message_buffer.truncate()
+        if parameters or prepare:
+            statement = self._send_prepared(query, parameters or ())
+            eop_tags = self._protocol.get_sync_eop_tags()
+        else:
+            self._socket_send(self._protocol.query(self._query))
+            statement = None
+            eop_tags = self._protocol.get_query_eop_tags()
+        self._pending = (eop_tags, statement)
+
+    def poll(self,):
+        """
+        Read data received for the pending query, blocking only when called
+        while the socket is not readable. Returns True once the result is
+        complete and available with get_rows() and get_nb_rows().
+        """
+        if self._pending is None:
+            return True
+        eop_tags, statement = self._pending
+        self._socket_recv()
+        # Data already decrypted by SSL does not make the socket readable.
+        pending = getattr(self._socket, 'pending', None)
+        while pending and pending() and \
+                not self._message_buffer.is_eop(eop_tags):
+            self._socket_recv()
+        if not self._message_buffer.is_eop(eop_tags):
+            return False
+        self._pending = None
+        if statement:
+            self._learn_result(statement)
+        self.get_nb_rows()
+        return True
+
+    def is_busy(self,):
+        """
+        Whether the result of the sent query is not complete yet.
+        """
+        return self._pending is not None
+
+
+def wait_all(connectors, timeout=None):
+    """
+    Wait for the results of queries sent by async connectors. A backend
+    error is raised once all results are complete.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    busy = [conn for conn in connectors if conn.is_busy()]
+    err = None
+    while busy:
+        remaining = None
+        if deadline is not None:
+            remaining = max(deadline - time.time(), 0)
+        readable = select.select(busy, [], [], remaining)[0]
+        if not readable:
+            raise error('PGC105', 'FATAL', "Timeout")
+        for conn in readable:
+            try:
+                done = conn.poll()
+            except error as e:
+                if e.code in ('PGC105', 'PGC106', 'PGC107'):
+                    raise
+                # The result is complete, the backend reported an error.
+                err = err or e
+                done = True
+            if done:
+                busy.remove(conn)
+    if err:
+        raise err
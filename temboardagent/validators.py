@@ -98,6 +98,15 @@ def syslogfacility(raw):
     return raw
 
 
+def timeout(raw):
+    timeout = int(raw)
+
+    if timeout <= 0:
+        raise ValueError('Timeout must be positive')
+
+    return timeout
+
+
 def writeabledir(raw):
     raw = dir_(raw)
     if not os.access(raw, os.W_OK):
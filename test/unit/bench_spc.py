@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Benchmark spc result decoding over a synthetic result set, without a
+# PostgreSQL server:
+#
+#     python test/unit/bench_spc.py [ROWS]
+#
+
+from __future__ import print_function
+
+import struct
+import sys
+import time
+
+from temboardagent.spc import connector
+
+
+def message(tag, data=b''):
+    return tag + struct.pack('!L', len(data) + 4) + data
+
+
+def synthetic_result(rows):
+    # Looks like pg_stat_activity: int, text, float, bool and text columns.
+    columns = [
+        (b'pid', 23), (b'database', 25), (b'duration', 701),
+        (b'waiting', 16), (b'query', 25),
+    ]
+    data = struct.pack('!H', len(columns))
+    for name, oid in columns:
+        data += name + b'\x00' + struct.pack('!LhLhlh', 0, 0, oid, -1, -1, 0)
+    result = [message(b'T', data)]
+    for i in range(rows):
+        values = [
+            str(10000 + i).encode(), b'postgres', b'%.2f' % (i / 7.),
+            b't' if i % 2 else b'f', b'SELECT * FROM pg_stat_activity',
+        ]
+        data = struct.pack('!H', len(values))
+        for value in values:
+            data += struct.pack('!l', len(value)) + value
+        result.append(message(b'D', data))
+    result.append(message(b'C', b'SELECT %d\x00' % rows))
+    result.append(message(b'Z', b'I'))
+    return b''.join(result)
+
+
+class ReplaySocket(object):
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def send(self, data):
+        self.offset = 0
+        return len(data)
+
+    def recv_into(self, buf, size):
+        chunk = self.data[self.offset:self.offset + size]
+        buf[0:len(chunk)] = chunk
+        self.offset += len(chunk)
+        return len(chunk)
+
+
+def bench(name, func, repeat=3):
+    best = min(timeit(func) for _ in range(repeat))
+    print("%-24s %8.3f s" % (name, best))
+
+
+def timeit(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def main(rows=100000):
+    conn = connector('localhost', 5432, 'bench')
+    conn._socket = ReplaySocket(synthetic_result(rows))
+
+    def execute():
+        conn.execute("SELECT ...")
+        assert rows == len(list(conn.get_rows()))
+
+    def execute_iter(row_factory='dict'):
+        assert rows == len(list(conn.execute_iter(
+            "SELECT ...", row_factory=row_factory)))
+
+    print("Decoding %d rows." % rows)
+    bench("execute + get_rows", execute)
+    bench("execute_iter", execute_iter)
+    bench("execute_iter tuple", lambda: execute_iter('tuple'))
+    bench("execute_iter namedtuple", lambda: execute_iter('namedtuple'))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
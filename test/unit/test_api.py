@@ -0,0 +1,20 @@
+import json
+
+
+def test_query_statistics(mocker):
+    from temboardagent.api import query_statistics
+    from temboardagent.postgres import query_stats
+
+    mocker.patch('temboardagent.api.check_sessionid')
+    mocker.patch.dict(query_stats._stats, clear=True)
+    query_stats.record(dict(
+        subsystem='test', operation='execute', query="SELECT 1",
+        duration=0.002, round_trips=1, bytes_received=60, rows=1, error=None,
+    ))
+
+    report = query_statistics({'headers': {}}, sessions=mocker.Mock())
+    # Served by the HTTP server with json.dumps().
+    stats, = json.loads(json.dumps(report))
+    assert 'SELECT 1' == stats['query']
+    assert 1 == stats['count']
+    assert [2, 1] in stats['histogram']
@@ -1,3 +1,8 @@
+import os
+
+import pytest
+
+
 def test_postgres_connect(mocker):
     mocker.patch('temboardagent.postgres.connector', autospec=True)
 
@@ -6,6 +11,17 @@ def test_postgres_connect(mocker):
     postgres = Postgres(host='myhost')
     with postgres.connect() as conn:
         assert conn
+    # Connection is given back to the pool and reset.
+    assert conn.close.called is False
+    assert conn.execute.called is True
+
+    # Connection left by any exception is discarded.
+    with pytest.raises(StopIteration):
+        with postgres.connect() as conn:
+            raise StopIteration()
+    assert conn.close.called is True
+
+    postgres.close()
     assert conn.close.called is True
 
     assert 'myhost' in repr(postgres)
@@ -23,7 +39,7 @@ def test_postgres_fetch_version(mocker):
     version = postgres.fetch_version()
 
     assert 90400 == version
-    assert conn.close.called is True
+    assert conn.connect.called is True
 
 
 def test_pickle():
@@ -33,3 +49,118 @@ def test_pickle():
     orig = Postgres(host='myhost')
     copy = unpickle(pickle(orig))
     assert 'myhost' == copy.host
+
+
+def test_pool(mocker):
+    c = mocker.patch('temboardagent.postgres.connector', autospec=True)
+    c.side_effect = lambda **kw: mocker.Mock(name='connector')
+
+    from temboardagent.postgres import Pool, Postgres
+    from temboardagent.spc import error
+
+    pool = Pool(Postgres(host='myhost'), max_size=2, wait_timeout=0)
+    conn0 = pool.getconn()
+    conn0.get_transaction_status.return_value = 'T'
+    conn1 = pool.getconn()
+    assert conn0 is not conn1
+    assert 'busy' in repr(pool)
+
+    # Pool is bounded.
+    with pytest.raises(error):
+        pool.getconn()
+
+    # Session is reset before being reused.
+    pool.putconn(conn0)
+    assert conn0.rollback.called is True
+    conn0.execute.assert_called_with(Pool.RESET_QUERY)
+    conn0.is_alive.return_value = True
+    assert conn0 is pool.getconn()
+
+    # Broken connections are recycled.
+    pool.putconn(conn0)
+    conn0.is_alive.return_value = False
+    conn2 = pool.getconn()
+    assert conn2 is not conn0
+    assert conn0.close.called is True
+
+    # Idle connections are recycled.
+    pool.putconn(conn1)
+    pool.idle_timeout = -1
+    conn1.is_alive.return_value = True
+    conn3 = pool.getconn()
+    assert conn3 is not conn1
+    assert conn1.close.called is True
+
+    # Discarded connections are closed.
+    pool.putconn(conn3, discard=True)
+    assert conn3.close.called is True
+
+    pool.close()
+    pool.putconn(conn2)
+    assert conn2.close.called is True
+    with pytest.raises(error):
+        pool.getconn()
+
+
+def test_postgres_pool(mocker):
+    import pickle
+    from threading import Thread
+    from temboardagent.postgres import Postgres
+
+    pool_cls = mocker.patch('temboardagent.postgres.Pool', autospec=True)
+    pool_cls.side_effect = lambda postgres: mocker.Mock(pid=os.getpid())
+
+    postgres = Postgres(host='myhost')
+    pools = []
+    threads = [
+        Thread(target=lambda: pools.append(postgres.pool)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert 1 == pool_cls.call_count
+    assert all(p is pools[0] for p in pools)
+
+    # Copy opens its own pool.
+    copy = pickle.loads(pickle.dumps(postgres))
+    assert copy.pool is not postgres.pool
+
+    postgres.close()
+    assert pools[0].close.called is True
+
+
+def test_query_stats():
+    from temboardagent.postgres import QueryStats
+
+    stats = QueryStats(max_statements=2)
+
+    def record(query, duration, error=None):
+        stats.record(dict(
+            subsystem='test', operation='execute', query=query,
+            duration=duration, round_trips=1, bytes_received=100, rows=2,
+            error=error,
+        ))
+
+    record("SELECT 1", 0.003)
+    record("SELECT 1", 0.150, error='57014')
+    record("SELECT 2", 0.001)
+    record("SELECT 3", 0.001)
+
+    report = stats.report()
+    slow = report[0]
+    assert 'SELECT 1' == slow['query']
+    assert 2 == slow['count']
+    assert 1 == slow['errors']
+    assert 153 == round(slow['duration'])
+    assert 150 == round(slow['max_duration'])
+    assert 4 == slow['rows']
+    assert 200 == slow['bytes_received']
+    histogram = dict(slow['histogram'])
+    assert 1 == histogram[5]
+    assert 1 == histogram[200]
+    assert 2 == sum(histogram.values())
+    # Beyond max_statements, statements are aggregated without text.
+    assert set(['SELECT 2', None]) == set(e['query'] for e in report[1:])
+
+    stats.reset()
+    assert [] == stats.report()
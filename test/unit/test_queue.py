@@ -0,0 +1,489 @@
+import json
+import os
+
+import pytest
+
+
+def test_push_shift(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')))
+    assert q.shift() is None
+    assert 0 == q.get_length()
+
+    for i in range(3):
+        q.push(Message(content=json.dumps({'i': i})))
+    assert 3 == q.get_length()
+
+    msg = q.shift(delete=False)
+    assert {'i': 0} == json.loads(msg.content)
+    assert 3 == q.get_length()
+
+    msg = q.shift()
+    assert {'i': 0} == json.loads(msg.content)
+    assert 2 == q.get_length()
+    assert [{'i': 1}, {'i': 2}] == q.get_content_all_messages()
+    assert [{'i': 2}, {'i': 1}] == list(q.get_last_n_messages(-1))
+    assert {'i': 2} == q.get_last_message()
+
+
+def test_segments(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')), segment_size=100)
+    for i in range(20):
+        q.push(Message(content=json.dumps({'i': i})))
+    segments = [f for f in os.listdir(q.file_path) if f.endswith('.log')]
+    assert len(segments) > 1
+
+    for i in range(19):
+        assert {'i': i} == json.loads(q.shift().content)
+    segments = [f for f in os.listdir(q.file_path) if f.endswith('.log')]
+    assert 1 == len(segments)
+    assert [{'i': 19}] == q.get_content_all_messages()
+    assert [{'i': 19}] == list(q.get_last_n_messages(5))
+
+
+def test_slide(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')), max_length=3, segment_size=100)
+    for i in range(10):
+        q.push(Message(content=json.dumps({'i': i})))
+    assert 3 == q.get_length()
+    assert [{'i': 7}, {'i': 8}, {'i': 9}] == q.get_content_all_messages()
+
+    q = Queue(str(tmpdir.join('test2.q')), max_size=100)
+    for i in range(10):
+        q.push(Message(content=json.dumps({'i': i})))
+    assert q.get_size() <= 100
+    assert {'i': 9} == q.get_last_message()
+
+
+def test_drop(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')), max_length=2, overflow_mode='drop')
+    for i in range(5):
+        q.push(Message(content=json.dumps({'i': i})))
+    assert [{'i': 0}, {'i': 1}] == q.get_content_all_messages()
+
+
+def test_legacy_file(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    path = tmpdir.join('test.q')
+    path.write('1520000000000000:0123abcde:{"i": 0}\n'
+               '1520000000000001:0123abcde:{"i": 1}\n')
+    q = Queue(str(path))
+    q.push(Message(content='{"i": 2}'))
+    assert path.check(dir=True)
+    assert [{'i': 0}, {'i': 1}, {'i': 2}] == q.get_content_all_messages()
+    assert 1520000000000001 == q.read_range(since_id=0, limit=2)[1].id
+    assert 3 == q.get_length()
+
+
+def test_legacy_file_concurrent(tmpdir):
+    from threading import Thread
+    from temboardagent.queue import Queue, Message
+
+    path = tmpdir.join('test.q')
+    path.write('1520000000000000:0123abcde:{"i": 0}\n')
+
+    def push(i):
+        Queue(str(path)).push(Message(content='{"i": %d}' % i))
+
+    threads = [Thread(target=push, args=(i,)) for i in range(1, 9)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    contents = Queue(str(path)).get_content_all_messages()
+    assert list(range(9)) == sorted(c['i'] for c in contents)
+    assert ['test.q'] == os.listdir(str(tmpdir))
+
+
+def test_purge_queue_dir(tmpdir):
+    from temboardagent.queue import Queue, Message, purge_queue_dir
+
+    Queue(str(tmpdir.join('keep.q'))).push(Message(content='{}'))
+    Queue(str(tmpdir.join('purge.q'))).push(Message(content='{}'))
+    tmpdir.join('legacy.q').write('')
+
+    purge_queue_dir(str(tmpdir), ['keep.q'])
+    assert ['keep.q'] == os.listdir(str(tmpdir))
+
+
+def test_meta(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')), segment_size=100)
+    for i in range(10):
+        q.push(Message(content=json.dumps({'i': i})))
+    size = q.get_size()
+    assert 10 == q.get_length()
+
+    # Metadata are rebuilt from segments.
+    os.remove(os.path.join(q.file_path, 'meta'))
+    assert 10 == q.get_length()
+    assert size == q.get_size()
+    q.shift()
+    assert 9 == q.get_length()
+
+    # Bytes written after the last metadata update are ignored, then
+    # overwritten.
+    q.push(Message(content='{"i": 10}'))
+    segments = sorted(f for f in os.listdir(q.file_path) if f.endswith('.log'))
+    with open(os.path.join(q.file_path, segments[-1]), 'ab') as fd:
+        fd.write('1234:torn')
+    assert {'i': 10} == q.get_last_message()
+    q.push(Message(content='{"i": 11}'))
+    assert 11 == q.get_length()
+    assert [{'i': 11}, {'i': 10}] == list(q.get_last_n_messages(2))
+
+
+def test_push_evicted(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')), max_length=5, segment_size=50)
+    for i in range(5):
+        assert 0 == q.push(Message(content=json.dumps({'i': i})))
+
+    q.max_length = 2
+    assert 4 == q.push(Message(content='{"i": 5}'))
+    assert [{'i': 4}, {'i': 5}] == q.get_content_all_messages()
+    segments = [f for f in os.listdir(q.file_path) if f.endswith('.log')]
+    assert len(segments) <= 2
+
+    q = Queue(str(tmpdir.join('drop.q')), max_length=1, overflow_mode='drop')
+    assert 0 == q.push(Message(content='{}'))
+    assert 1 == q.push(Message(content='{}'))
+
+
+def test_raw(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')))
+    for i in range(3):
+        q.push(Message(content=json.dumps({'i': i})))
+
+    assert ['{"i": 0}', '{"i": 1}', '{"i": 2}'] == \
+        q.get_content_all_messages(raw=True)
+    assert ['{"i": 2}', '{"i": 1}'] == \
+        list(q.get_last_n_messages(2, raw=True))
+
+
+def test_read_range(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    t = 1500000000000000
+    q = Queue(str(tmpdir.join('test.q')), segment_size=400, index_interval=80)
+    for i in range(100):
+        q.push(Message(id=t + i * 10, content=json.dumps({'i': i})))
+    assert len(os.listdir(q.file_path)) > 10
+
+    messages = q.read_range(since_id=t + 500, until_id=t + 550)
+    assert [510, 520, 530, 540, 550] == [int(m.id) - t for m in messages]
+    assert {'i': 51} == json.loads(messages[0].content)
+
+    messages = q.read_range(since_id=t + 505, limit=2)
+    assert [510, 520] == [int(m.id) - t for m in messages]
+
+    assert 100 == len(q.read_range())
+    assert [0] == [int(m.id) - t for m in q.read_range(until_id=t)]
+    assert [] == q.read_range(since_id=t + 1000)
+
+    # Consumed messages are not returned.
+    for _ in range(60):
+        q.shift()
+    assert t + 600 == int(q.read_range(since_id=0, limit=1)[0].id)
+
+
+def test_cursor(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')), segment_size=100)
+    for i in range(20):
+        q.push(Message(content=json.dumps({'i': i})))
+
+    a = q.cursor('a')
+    batch = a.read_batch(3)
+    assert [0, 1, 2] == [json.loads(m.content)['i'] for _, m in batch]
+    # Reading is not consuming.
+    assert [o for o, _ in batch] == [o for o, _ in a.read_batch(3)]
+    assert 20 == q.get_length()
+
+    a.ack(batch[-1][0])
+    batch = a.read_batch(100)
+    assert 17 == len(batch)
+    assert {'i': 3} == json.loads(batch[0][1].content)
+
+    # Cursor position is persisted.
+    assert 17 == len(Queue(q.file_path).cursor('a').read_batch(100))
+
+    # Segments are kept until all cursors have passed them.
+    b = q.cursor('b')
+    b.ack(b.read_batch(1)[0][0])
+    n_segments = len(os.listdir(q.file_path))
+    length = q.get_length()
+    a.ack(batch[-1][0])
+    assert n_segments == len(os.listdir(q.file_path))
+    assert length == q.get_length()
+
+    b.ack(batch[-1][0])
+    assert len(os.listdir(q.file_path)) < n_segments
+    assert q.get_length() < length
+    assert q.get_length() == len(q.get_content_all_messages())
+    assert [] == b.read_batch(1)
+
+
+def test_cursor_slide(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')), max_length=3)
+    for i in range(3):
+        q.push(Message(content=json.dumps({'i': i})))
+    cursor = q.cursor('a')
+    cursor.ack(cursor.read_batch(2)[-1][0])
+
+    # Only evicted messages not read by the cursor are lost.
+    assert 0 == q.push(Message(content='{"i": 3}'))
+    assert 0 == q.push(Message(content='{"i": 4}'))
+    assert 1 == q.push(Message(content='{"i": 5}'))
+    assert [3, 4, 5] == [
+        json.loads(m.content)['i'] for _, m in cursor.read_batch(10)]
+
+
+def test_records(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')), compress=True)
+    content = json.dumps({'data': ['value'] * 100})
+    q.push(Message(content=content))
+    assert q.get_size() < len(content)
+    q.push(Message(content='{"i": 1}'))
+    q.push(Message(content='{"i": 2}'))
+    assert content == q.get_content_all_messages(raw=True)[0]
+
+    # Corrupt the last record, it is skipped.
+    segment = os.path.join(q.file_path, '%020d.log' % 0)
+    with open(segment, 'r+b') as fd:
+        fd.seek(-3, os.SEEK_END)
+        fd.write('{"x')
+    assert [{'i': 1}] == q.get_content_all_messages()[1:]
+    assert {'i': 1} == q.get_last_message()
+
+
+def test_torn_first_push(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')))
+    # A crash during the first push leaves a partial record and no meta.
+    q._setup()
+    segment = os.path.join(q.file_path, '%020d.log' % 0)
+    with open(segment, 'wb') as fd:
+        fd.write(Message(content='{"i": -1}').serialize()[:10])
+
+    for i in range(5):
+        q.push(Message(content=json.dumps({'i': i})))
+    assert 5 == q.get_length()
+    assert [{'i': i} for i in range(5)] == q.get_content_all_messages()
+    assert 5 == len(q.cursor('sender').read_batch(10))
+
+
+def test_interrupted_push_many(tmpdir):
+    import shutil
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')), segment_size=50)
+    q.push(Message(content='{"i": 0}'))
+    meta = os.path.join(q.file_path, 'meta')
+    shutil.copy(meta, meta + '.bak')
+    # A crash before metadata are written leaves records of a batch over
+    # several segments after the tail.
+    q.push_many([Message(content=json.dumps({'i': i})) for i in range(3)])
+    assert 2 == len([f for f in os.listdir(q.file_path)
+                     if f.endswith('.log')])
+    os.rename(meta + '.bak', meta)
+
+    assert 1 == q.get_length()
+    assert [{'i': 0}] == q.get_content_all_messages()
+    assert [{'i': 0}] == list(q.get_last_n_messages(-1))
+
+    q.push(Message(content='{"i": 1}'))
+    assert 2 == q.get_length()
+    assert [{'i': 0}, {'i': 1}] == q.get_content_all_messages()
+    assert [{'i': 1}, {'i': 0}] == list(q.get_last_n_messages(-1))
+
+
+def test_corrupted_length(tmpdir):
+    from temboardagent.queue import Queue, Message, RECORD_HEADER
+
+    q = Queue(str(tmpdir.join('test.q')))
+    for i in range(5):
+        q.push(Message(content=json.dumps({'i': i})))
+
+    # Corrupt the length of the second record, later ones are found back.
+    record_size = RECORD_HEADER.size + len('{"i": 0}')
+    segment = os.path.join(q.file_path, '%020d.log' % 0)
+    with open(segment, 'r+b') as fd:
+        fd.seek(record_size + 2)
+        fd.write(b'\x00\x00\x10\x00')
+    assert [0, 2, 3, 4] == [m['i'] for m in q.get_content_all_messages()]
+    assert [4, 3, 2, 0] == [m['i'] for m in q.get_last_n_messages(-1)]
+
+
+def test_push_many(tmpdir):
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')), segment_size=100, max_length=15)
+    lost = q.push_many([Message(content=json.dumps({'i': i}))
+                        for i in range(20)])
+    assert 5 == lost
+    assert 15 == q.get_length()
+    assert [{'i': i} for i in range(5, 20)] == q.get_content_all_messages()
+    segments = [f for f in os.listdir(q.file_path) if f.endswith('.log')]
+    assert len(segments) > 1
+
+    q = Queue(str(tmpdir.join('drop.q')), max_length=3, overflow_mode='drop')
+    assert 0 == q.push(Message(content='{"i": 0}'))
+    lost = q.push_many([Message(content=json.dumps({'i': i}))
+                        for i in range(1, 5)])
+    assert 2 == lost
+    assert [{'i': 0}, {'i': 1}, {'i': 2}] == q.get_content_all_messages()
+
+
+def test_fsync(tmpdir, mocker):
+    from temboardagent.queue import Queue, Message
+
+    fsync = mocker.patch('temboardagent.queue.os.fsync')
+    q = Queue(str(tmpdir.join('none.q')))
+    q.push(Message(content='{}'))
+    assert not fsync.called
+
+    q = Queue(str(tmpdir.join('batch.q')), fsync='batch')
+    q.push_many([Message(content='{}'), Message(content='{}')])
+    # Segment, metadata and directory.
+    assert 3 == fsync.call_count
+
+    fsync.reset_mock()
+    q = Queue(str(tmpdir.join('interval.q')), fsync='interval',
+              fsync_interval=3600)
+    q.push(Message(content='{}'))
+    assert fsync.called
+    fsync.reset_mock()
+    q.push(Message(content='{}'))
+    assert not fsync.called
+
+
+def test_cursor_wait(tmpdir):
+    import threading
+    import time
+    from temboardagent.queue import Queue, Message
+
+    q = Queue(str(tmpdir.join('test.q')))
+    cursor = q.cursor('a')
+    start = time.time()
+    assert cursor.wait(0.1) is False
+    assert time.time() - start >= 0.1
+
+    def push():
+        time.sleep(0.1)
+        Queue(q.file_path).push(Message(content='{}'))
+
+    pusher = threading.Thread(target=push)
+    pusher.start()
+    start = time.time()
+    assert cursor.wait(10) is True
+    assert time.time() - start < 5
+    pusher.join()
+
+    # Pending messages do not block.
+    assert cursor.wait(0) is True
+    cursor.ack(cursor.read_batch(1)[0][0])
+    assert cursor.wait(0) is False
+
+
+def test_ring(tmpdir):
+    from temboardagent.queue import RingQueue, Message
+
+    path = str(tmpdir.join('ring.q'))
+    reader = RingQueue(path)
+    assert 0 == reader.get_length()
+    assert [] == reader.get_content_all_messages()
+
+    q = RingQueue(path, max_length=3, slot_size=64)
+    for i in range(2):
+        assert 0 == q.push(Message(content=json.dumps({'i': i})))
+    assert 2 == reader.get_length()
+    assert [{'i': 0}, {'i': 1}] == reader.get_content_all_messages()
+
+    assert 0 == q.push(Message(content='{"i": 2}'))
+    for i in range(3, 5):
+        assert 1 == q.push(Message(content=json.dumps({'i': i})))
+    assert 3 == reader.get_length()
+    assert [{'i': 2}, {'i': 3}, {'i': 4}] == reader.get_content_all_messages()
+    assert {'i': 4} == reader.get_last_message()
+    assert ['{"i": 4}', '{"i": 3}'] == \
+        reader.get_last_n_messages(2, raw=True)
+
+    with pytest.raises(ValueError):
+        q.push(Message(content='x' * 64))
+
+    # Changing ring geometry resets the ring.
+    q = RingQueue(path, max_length=5, slot_size=64)
+    q.push(Message(content='{"i": 5}'))
+    assert [{'i': 5}] == reader.get_content_all_messages()
+
+
+def test_ring_interrupted_write(tmpdir):
+    import struct
+    from temboardagent.queue import RING_SEQ_OFFSET, RingQueue, Message
+
+    path = tmpdir.join('ring.q')
+    q = RingQueue(str(path), max_length=3, slot_size=64)
+    q.push(Message(content='{"i": 0}'))
+
+    def seq():
+        with path.open('rb') as fd:
+            fd.seek(RING_SEQ_OFFSET)
+            return struct.unpack('!Q', fd.read(8))[0]
+
+    # Writer killed after marking its write in progress.
+    with path.open('r+b') as fd:
+        fd.seek(RING_SEQ_OFFSET)
+        fd.write(struct.pack('!Q', seq() + 1))
+    assert [{'i': 0}] == q.get_content_all_messages()
+
+    q.push(Message(content='{"i": 1}'))
+    assert 0 == seq() % 2
+    assert [{'i': 0}, {'i': 1}] == q.get_content_all_messages()
+
+
+def test_ring_concurrent_read(tmpdir):
+    import threading
+    from temboardagent.queue import RingQueue, Message
+
+    path = str(tmpdir.join('ring.q'))
+    q = RingQueue(path, max_length=4, slot_size=128)
+    stop = []
+
+    def push():
+        i = 0
+        while not stop:
+            q.push(Message(content=json.dumps({'i': i, 'pad': 'x' * 64})))
+            i += 1
+
+    pusher = threading.Thread(target=push)
+    pusher.start()
+    try:
+        reader = RingQueue(path)
+        for _ in range(200):
+            values = [m['i'] for m in reader.get_content_all_messages()]
+            # Snapshots are consistent: consecutive messages.
+            assert values == list(range(values[0], values[0] + len(values))) \
+                if values else True
+    finally:
+        stop.append(True)
+        pusher.join()
@@ -1,6 +1,610 @@
-def  test_set_parameter_status():
+import pytest
+
+
+def test_set_parameter_status():
     from temboardagent.spc import connector
 
     c = connector('foo', 'bar', 'dude')
     c._set_parameter_status('server_version', '10.3 (Debian 10.3-1.pgdg90+1)')
     assert c._pg_version == 100300
+
+
+class FakeSocket(object):
+    # Replay backend responses, one per send().
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+        self.pending = b''
+
+    def send(self, data):
+        self.sent.append(data)
+        self.pending += self.responses.pop(0)
+        return len(data)
+
+    def recv_into(self, buf, length):
+        data, self.pending = self.pending[:length], self.pending[length:]
+        buf[0:len(data)] = data
+        return len(data)
+
+
+def message(tag, data=b''):
+    import struct
+    return tag + struct.pack('!L', len(data) + 4) + data
+
+
+def row_description(*names):
+    import struct
+    data = struct.pack('!H', len(names))
+    for name in names:
+        data += name + b'\x00' + struct.pack('!LhLhlh', 0, 0, 23, 4, -1, 0)
+    return message(b'T', data)
+
+
+def data_row(*values):
+    import struct
+    data = struct.pack('!H', len(values))
+    for value in values:
+        if value is None:
+            data += struct.pack('!l', -1)
+        else:
+            data += struct.pack('!l', len(value)) + value
+    return message(b'D', data)
+
+
+def test_execute_prepared():
+    from temboardagent.spc import connector
+
+    select = row_description(b'one') + data_row(b'1') \
+        + message(b'C', b'SELECT 1\x00') + message(b'Z', b'I')
+    c = connector('foo', 'bar', 'dude')
+    c._socket = FakeSocket(
+        message(b'1') + message(b'2') + select,
+        message(b'2') + select,
+        message(b'C', b'DISCARD ALL\x00') + message(b'Z', b'I'),
+    )
+
+    c.execute("SELECT %s AS one WHERE 'a' LIKE '%%'", (1,))
+    assert [{'one': 1}] == list(c.get_rows())
+    sent = c._socket.sent[0]
+    assert sent.startswith(b'P')
+    assert b"SELECT $1 AS one WHERE 'a' LIKE '%'\x00" in sent
+    assert b'\x00\x00\x00\x011' in sent
+
+    # Second run reuses the prepared statement.
+    c.execute("SELECT %s AS one WHERE 'a' LIKE '%%'", (1,))
+    assert 1 == c.get_nb_rows()
+    assert c._socket.sent[1].startswith(b'B')
+    assert 'I' == c.get_transaction_status()
+
+    c.execute("DISCARD ALL")
+    assert not c._statements
+
+
+def test_execute_prepared_error():
+    from temboardagent.spc import connector, error
+
+    c = connector('foo', 'bar', 'dude')
+    c._socket = FakeSocket(
+        message(b'E', b'SERROR\x00C42601\x00Msyntax error\x00\x00')
+        + message(b'Z', b'I'),
+    )
+    with pytest.raises(error) as ei:
+        c.execute("SELECT FROM WHERE", prepare=True)
+    assert '42601' == ei.value.code
+    assert not c._statements
+
+
+def test_execute_prepared_placeholders():
+    from temboardagent.spc import connector, error
+
+    c = connector('foo', 'bar', 'dude')
+    c._socket = FakeSocket(message(b'Z', b'I'))
+    # Without parameters, the query is sent as is.
+    c.execute("SELECT '%sql%%'", prepare=True)
+    assert b"SELECT '%sql%%'\x00" in c._socket.sent[0]
+
+    for query, parameters in [("SELECT %s, %s", (1,)), ("SELECT 1", (1,))]:
+        with pytest.raises(error) as ei:
+            c.execute(query, parameters)
+        assert 'PGC110' == ei.value.code
+        with pytest.raises(error):
+            list(c.execute_iter(query, parameters))
+    assert 1 == len(c._socket.sent)
+
+
+def test_execute_iter():
+    from temboardagent.spc import connector, error
+
+    result = row_description(b'one') \
+        + b''.join(data_row(str(i).encode()) for i in range(100)) \
+        + message(b'C', b'SELECT 100\x00') + message(b'Z', b'I')
+    c = connector('foo', 'bar', 'dude')
+    c._socket = FakeSocket(result, result)
+    c._socket_read_length = 7
+
+    rows = c.execute_iter("SELECT generate_series(0, 99) AS one")
+    assert {'one': 0} == next(rows)
+    # Messages are parsed as soon as received.
+    assert len(c._socket.pending) > len(result) / 2
+    assert 99 == len(list(rows))
+    assert 100 == c.get_nb_rows()
+    assert 'I' == c.get_transaction_status()
+
+    # Stopping early drains the rest of the result.
+    rows = c.execute_iter("SELECT generate_series(0, 99) AS one")
+    next(rows)
+    rows.close()
+    assert b'' == c._socket.pending
+
+    c._socket = FakeSocket(
+        row_description(b'one') + data_row(b'1')
+        + message(b'E', b'SERROR\x00C22012\x00Mdivision by zero\x00\x00')
+        + message(b'Z', b'I'),
+    )
+    rows = c.execute_iter("SELECT 1 / (1 - i) AS one FROM ...")
+    with pytest.raises(error):
+        list(rows)
+    assert b'' == c._socket.pending
+
+
+def test_message_buffer():
+    from temboardagent.spc import message_buffer
+
+    big = message(b'd', b'x' * 200000)
+    data = message(b'C', b'SELECT 1\x00') + big + message(b'Z', b'I')
+    buf = message_buffer()
+    buf.write(data[:12])
+    assert not buf.is_eop([b'Z'])
+    assert [] == list(buf.get_messages_stream())
+    sock = FakeSocket(data[12:])
+    sock.send(b'')
+    while not buf.is_eop([b'Z']):
+        assert buf.recv_into(sock, 65536)
+
+    assert [data[:14], big] == list(buf.get_messages())[:2]
+    assert 3 == len(list(buf.get_messages_stream()))
+    # Stream consumed everything.
+    assert [] == list(buf.get_messages())
+    buf.truncate()
+    assert len(buf._buf) == buf._default_size
+
+
+def test_adaptive_read_length():
+    from temboardagent.spc import connector
+
+    c = connector('foo', 'bar', 'dude')
+    c._socket = FakeSocket(message(b'd', b'x' * 100000) + message(b'Z', b'I'))
+    c._socket.send(b'')
+    c._socket_read([b'Z'])
+    assert c._socket_read_length > c._socket_read_min
+    c._socket = FakeSocket(message(b'Z', b'I'))
+    c._socket.send(b'')
+    c._socket_read([b'Z'])
+    assert c._socket_read_length < c._socket_read_max
+
+
+def test_row_decoder():
+    from temboardagent.spc import connector
+
+    def col(name, oid, fmt=0):
+        return dict(name=name, type_oid=oid, format_code=fmt)
+
+    c = connector('foo', 'bar', 'dude')
+    row_desc = [
+        col('i', 23), col('f', 701), col('b', 16), col('t', 25), col('x', 20),
+        col('x', 25),
+    ]
+    decode = c._get_decoder(row_desc)
+    assert decode is c._get_decoder(list(row_desc))
+    assert {'i': 1, 'f': 1.5, 'b': True, 't': 't', 'x': '2'} == decode(
+        data_row(b'1', b'1.5', b't', b't', b'1', b'2'))
+    assert {'i': None, 'f': None, 'b': None, 't': None, 'x': None} == decode(
+        data_row(None, None, None, None, None, None))
+
+
+def test_row_factories():
+    from temboardagent.spc import connector, error
+
+    c = connector('foo', 'bar', 'dude')
+    result = row_description(b'one', b'two', b'one', b'?column?') \
+        + data_row(b'1', None, b'3', b'4') \
+        + message(b'C', b'SELECT 1\x00') + message(b'Z', b'I')
+    c._message_buffer.write(result)
+
+    assert [(1, None, 3, 4)] == list(c.get_rows(row_factory='tuple'))
+    row, = c.get_rows(row_factory='namedtuple')
+    assert (1, None, 3, 4) == row
+    assert ('one', 'two', '_2', '_3') == row._fields
+    assert 1 == row.one
+    assert type(row) is type(next(c.get_rows(row_factory='namedtuple')))
+    assert [{'one': 3, 'two': None, '?column?': 4}] == list(c.get_rows())
+
+    with pytest.raises(error):
+        list(c.get_rows(row_factory='object'))
+
+
+def test_row_decoder_binary():
+    import struct
+    from datetime import datetime, timedelta
+    from temboardagent.spc import connector
+
+    def col(name, oid, fmt=1):
+        return dict(name=name, type_oid=oid, format_code=fmt)
+
+    c = connector('foo', 'bar', 'dude')
+    row_desc = [
+        col('i2', 21), col('i4', 23), col('i8', 20), col('f4', 700),
+        col('f8', 701), col('b', 16), col('ts', 1184), col('t', 25, 0),
+        col('n', 1700, 0),
+    ]
+    # Results of a statement have the same values whatever the format:
+    # float4 and timestamptz stay in text, float8 until PostgreSQL 12.
+    assert (1, 1, 1, 0, 0, 1, 0, 0, 0) == c._get_result_formats(row_desc)
+    c._pg_version = 120000
+    assert (1, 1, 1, 0, 1, 1, 0, 0, 0) == c._get_result_formats(row_desc)
+    assert () == c._get_result_formats([col('t', 25, 0)])
+
+    decode = c._get_decoder(row_desc)
+    row = decode(data_row(
+        struct.pack('!h', -2), struct.pack('!i', 4), struct.pack('!q', 2**40),
+        struct.pack('!f', 0.5), struct.pack('!d', 1.25), b'\x01',
+        struct.pack('!q', 86400 * 10 ** 6 + 1), b'text', b'1.5',
+    ))
+    ts = row.pop('ts')
+    assert {
+        'i2': -2, 'i4': 4, 'i8': 2**40, 'f4': 0.5, 'f8': 1.25, 'b': True,
+        't': 'text', 'n': 1.5,
+    } == row
+    assert timedelta(0) == ts.utcoffset()
+    assert datetime(2000, 1, 2, 0, 0, 0, 1) == ts.replace(tzinfo=None)
+
+    row = decode(data_row(*[None] * 9))
+    assert set([None]) == set(row.values())
+
+
+def test_execute_prepared_binary():
+    import struct
+    from temboardagent.spc import connector
+
+    def result(fmt, value):
+        return message(b'T', struct.pack('!H', 1) + b'n\x00' + struct.pack(
+            '!LhLhlh', 0, 0, 20, 8, -1, fmt)) + data_row(value) \
+            + message(b'C', b'SELECT 1\x00') + message(b'Z', b'I')
+
+    c = connector('foo', 'bar', 'dude')
+    c._socket = FakeSocket(
+        message(b'1') + message(b'2') + result(0, b'42'),
+        message(b'2') + result(1, struct.pack('!q', 42)),
+    )
+    c.execute("SELECT count(*) AS n FROM pg_class", prepare=True)
+    assert [{'n': 42}] == list(c.get_rows())
+    # Second execution requests binary format for the int8 column.
+    rows = c.execute_iter("SELECT count(*) AS n FROM pg_class", prepare=True)
+    assert [{'n': 42}] == list(rows)
+    assert c._socket.sent[1].endswith(
+        struct.pack('!Hh', 1, 1) + b'D\x00\x00\x00\x06P\x00'
+        + b'E\x00\x00\x00\x09\x00\x00\x00\x00\x00'
+        + b'S\x00\x00\x00\x04')
+
+
+def test_execute_prepared_null_bool():
+    import struct
+    from temboardagent.spc import connector
+
+    def result(fmt):
+        return message(b'T', struct.pack('!H', 1) + b'b\x00' + struct.pack(
+            '!LhLhlh', 0, 0, 16, 1, -1, fmt)) + data_row(None) \
+            + message(b'C', b'SELECT 1\x00') + message(b'Z', b'I')
+
+    c = connector('foo', 'bar', 'dude')
+    c._socket = FakeSocket(
+        message(b'1') + message(b'2') + result(0),
+        message(b'2') + result(1),
+    )
+    # NULL is None, in text format and then in binary format.
+    c.execute("SELECT NULL::bool AS b", prepare=True)
+    assert [{'b': None}] == list(c.get_rows())
+    c.execute("SELECT NULL::bool AS b", prepare=True)
+    assert [{'b': None}] == list(c.get_rows())
+    assert c._socket.sent[1].endswith(
+        struct.pack('!Hh', 1, 1) + b'D\x00\x00\x00\x06P\x00'
+        + b'E\x00\x00\x00\x09\x00\x00\x00\x00\x00'
+        + b'S\x00\x00\x00\x04')
+
+
+def test_execute_batch():
+    from temboardagent.spc import connector, error
+
+    c = connector('foo', 'bar', 'dude')
+    c._socket = FakeSocket(
+        message(b'1') + message(b'2') + row_description(b'one')
+        + data_row(b'1') + message(b'C', b'SELECT 1\x00')
+        + message(b'1') + message(b'2') + message(b'n')
+        + message(b'C', b'SET\x00')
+        + message(b'1') + message(b'2') + row_description(b'two')
+        + data_row(b'2') + data_row(b'3') + message(b'C', b'SELECT 2\x00')
+        + message(b'Z', b'I'),
+        message(b'2') + row_description(b'one') + data_row(b'1')
+        + message(b'C', b'SELECT 1\x00')
+        + message(b'E', b'SERROR\x00C42P01\x00Mno such table\x00\x00')
+        + message(b'Z', b'I'),
+    )
+
+    results = c.execute_batch([
+        "SELECT 1 AS one",
+        ("SET application_name TO %s", ('temboard',)),
+        "SELECT generate_series(2, 3) AS two",
+    ])
+    assert [[{'one': 1}], [], [{'two': 2}, {'two': 3}]] == results
+    assert 3 == len(c._statements)
+    assert c._query.startswith("SELECT 1 AS one;\nSET application_name")
+    sent = c._socket.sent[0]
+    assert 3 == sent.count(b'E\x00\x00\x00\x09')
+    assert sent.endswith(b'S\x00\x00\x00\x04')
+    assert 1 == sent.count(b'S\x00\x00\x00\x04')
+
+    with pytest.raises(error):
+        c.execute_batch(["SELECT 1 AS one", "SELECT * FROM nowhere"])
+    assert 3 == len(c._statements)
+
+
+def test_execute_timeout(mocker):
+    import socket
+    import time
+    from temboardagent.spc import connector, error
+
+    class SlowSocket(FakeSocket):
+        timeout = 60
+
+        def gettimeout(self):
+            return self.timeout
+
+        def settimeout(self, timeout):
+            self.timeout = timeout
+
+        def recv_into(self, buf, length):
+            if not self.pending:
+                time.sleep(self.timeout)
+                raise socket.timeout()
+            return super(SlowSocket, self).recv_into(buf, length)
+
+    c = connector('foo', 'bar', 'dude')
+    c._backend_pid, c._backend_key = 1234, 5678
+    c._socket = SlowSocket(b'')
+    side = mocker.patch.object(c, '_create_new_socket').return_value
+
+    def cancel(data):
+        c._socket.pending += (
+            message(b'E', b'SERROR\x00C57014\x00Mcanceling\x00\x00')
+            + message(b'Z', b'I'))
+    side.sendall.side_effect = cancel
+
+    with pytest.raises(error) as ei:
+        c.execute("SELECT pg_sleep(10)", timeout=0.01)
+    assert '57014' == ei.value.code
+    side.sendall.assert_called_once_with(
+        b'\x00\x00\x00\x10\x04\xd2\x16\x2e\x00\x00\x04\xd2\x00\x00\x16\x2e')
+    assert side.close.called is True
+    assert 60 == c._socket.timeout
+    assert b'' == c._socket.pending
+
+
+def test_copy_out():
+    import struct
+    from temboardagent.spc import connector
+
+    copy_response = message(b'H', b'\x00\x00\x03\x00\x00\x00\x00\x00\x00')
+    end = message(b'c') + message(b'C', b'COPY 2\x00') + message(b'Z', b'I')
+    c = connector('foo', 'bar', 'dude')
+    c._socket = FakeSocket(
+        copy_response
+        + message(b'd', b'1,,"a ""b"", c"\n')
+        + message(b'd', b'2,"",\n') + end,
+    )
+
+    rows = list(c.copy_out("SELECT * FROM t"))
+    assert [('1', None, 'a "b", c'), ('2', '', None)] == rows
+    assert 2 == c.get_nb_rows()
+    assert c._socket.sent[0][5:] == \
+        b'COPY (SELECT * FROM t) TO STDOUT WITH (FORMAT csv)\x00'
+
+    header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!LL', 0, 0)
+    row = struct.pack('!hl', 3, 4) + struct.pack('!i', 42) \
+        + struct.pack('!l', -1) + struct.pack('!l', 3) + b'foo'
+    c._socket = FakeSocket(
+        copy_response + message(b'd', header + row)
+        + message(b'd', struct.pack('!h', -1)) + end,
+        copy_response + message(b'd', header + row)
+        + message(b'd', struct.pack('!h', -1)) + end,
+    )
+
+    rows = list(c.copy_out("SELECT * FROM t", format='binary'))
+    assert [(b'\x00\x00\x00\x2a', None, b'foo')] == rows
+    rows = list(c.copy_out(
+        "SELECT * FROM t", format='binary', types=(23, 23, 25)))
+    assert [(42, None, 'foo')] == rows
+
+
+def test_async_connector():
+    import socket
+    from temboardagent.spc import async_connector, error, wait_all
+
+    conns, servers = [], []
+    for i in range(3):
+        conn = async_connector('foo', 'bar', 'dude')
+        conn._socket, server = socket.socketpair()
+        conns.append(conn)
+        servers.append(server)
+
+    for i, conn in enumerate(conns):
+        conn.send_query("SELECT %d AS one" % i)
+        assert conn.is_busy()
+    for server in servers:
+        assert server.recv(1024).startswith(b'Q')
+
+    # Answer in reverse order, the second result in two parts.
+    servers[2].sendall(row_description(b'one') + data_row(b'2')
+                       + message(b'C', b'SELECT 1\x00') + message(b'Z', b'I'))
+    servers[1].sendall(row_description(b'one'))
+    assert not conns[1].poll()
+    servers[1].sendall(data_row(b'1') + message(b'C', b'SELECT 1\x00')
+                       + message(b'Z', b'I'))
+    servers[0].sendall(message(b'E', b'SERROR\x00C42P01\x00Mnope\x00\x00')
+                       + message(b'Z', b'I'))
+
+    with pytest.raises(error) as ei:
+        wait_all(conns, timeout=5)
+    assert '42P01' == ei.value.code
+    assert [{'one': 1}] == list(conns[1].get_rows())
+    assert [{'one': 2}] == list(conns[2].get_rows())
+    assert not any(conn.is_busy() for conn in conns)
+
+    conns[0].send_query("SELECT pg_sleep(10)")
+    with pytest.raises(error) as ei:
+        wait_all(conns, timeout=0.01)
+    assert 'PGC105' == ei.value.code
+
+    for sock in servers + [conn._socket for conn in conns]:
+        sock.close()
+
+
+def test_resolve_cache(mocker):
+    import socket
+    from temboardagent import spc
+
+    mocker.patch.dict(spc._addresses, clear=True)
+    gai = mocker.patch('temboardagent.spc.socket.getaddrinfo', return_value=[
+        (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('192.0.2.1', 5432)),
+    ])
+
+    for _ in range(2):
+        c = spc.connector('db.example', 5432, 'dude')
+        c._set_ip_type()
+        assert '192.0.2.1' == c._host_ip4
+    assert 1 == gai.call_count
+
+    # Expired entries are resolved again.
+    spc._addresses[('db.example', 5432)] = (0, (None, None, None))
+    c._set_ip_type()
+    assert 2 == gai.call_count
+
+    c = spc.connector('/var/run/postgresql', 5432, 'dude')
+    c._set_ip_type()
+    assert '/var/run/postgresql' == c._host_unix
+    # No SSLRequest on Unix sockets.
+    sock = mocker.Mock(name='socket')
+    c._wrap_ssl_socket(sock)
+    assert sock.send.called is False
+    assert sock is c._socket
+
+
+def test_connect_tcp():
+    import socket
+    import time
+    from temboardagent.spc import connector, error
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+
+    c = connector('127.0.0.1', port, 'dude', connect_timeout=5)
+    c._connect_attempt_delay = 0.01
+    # An unreachable address does not delay the next one.
+    sock = c._connect_tcp([
+        (socket.AF_INET, '192.0.2.1'), (socket.AF_INET, '127.0.0.1')])
+    assert ('127.0.0.1', port) == sock.getpeername()
+    c._set_keepalive(sock)
+    assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+    sock.close()
+
+    sock = c._create_new_socket()
+    assert 60 == sock.gettimeout()
+    sock.close()
+    server.close()
+
+    c = connector('192.0.2.1', port, 'dude', connect_timeout=0.1)
+    start = time.time()
+    with pytest.raises(error) as ei:
+        c._create_new_socket()
+    assert 'PGC101' == ei.value.code
+    assert time.time() - start < 1
+
+
+def test_hooks():
+    from temboardagent.spc import add_hook, connector, error, remove_hook
+
+    records = []
+
+    def hook(stats):
+        records.append(dict(stats))
+
+    add_hook(hook)
+    try:
+        c = connector('foo', 'bar', 'dude')
+        c.set_subsystem('test')
+        result = row_description(b'one') + data_row(b'1') + data_row(b'2') \
+            + message(b'C', b'SELECT 2\x00') + message(b'Z', b'I')
+        c._socket = FakeSocket(
+            result,
+            message(b'E', b'SERROR\x00C42P01\x00Mnope\x00\x00')
+            + message(b'Z', b'I'),
+        )
+
+        c.execute("SELECT 1")
+        assert 2 == len(list(c.get_rows()))
+        with pytest.raises(error):
+            c.execute("SELECT nope")
+    finally:
+        remove_hook(hook)
+
+    execute, get_rows, failed = records
+    assert 'execute' == execute['operation']
+    assert 'SELECT 1' == execute['query']
+    assert 'test' == execute['subsystem']
+    assert 1 == execute['round_trips']
+    assert len(result) == execute['bytes_received']
+    assert 2 == execute['rows']
+    assert execute['error'] is None
+    assert execute['duration'] >= 0
+    assert 'get_rows' == get_rows['operation']
+    assert 0 == get_rows['round_trips']
+    assert 2 == get_rows['rows']
+    assert '42P01' == failed['error']
+
+
+def test_wait_notify():
+    import socket
+    import struct
+    import time
+    from temboardagent.spc import connector
+
+    def notification(channel, payload):
+        data = struct.pack('!L', 42) + channel + b'\x00' + payload + b'\x00'
+        return message(b'A', data)
+
+    c = connector('foo', 'bar', 'dude')
+    c._socket, server = socket.socketpair()
+
+    # Notifications within a result and right after it.
+    last = notification(b'reload', b'')
+    server.sendall(
+        message(b'C', b'NOTIFY\x00') + notification(b'reload', b'hba')
+        + message(b'Z', b'I') + last[:6])
+    c.execute("NOTIFY reload, 'hba'")
+    assert [] == list(c.get_rows())
+    assert [{'pid': 42, 'channel': 'reload', 'payload': 'hba'}] == \
+        c.wait_notify(0)
+    server.sendall(last[6:])
+    assert [{'pid': 42, 'channel': 'reload', 'payload': ''}] == \
+        c.wait_notify(0)
+
+    start = time.time()
+    assert [] == c.wait_notify(0.01)
+    assert time.time() - start < 1
+
+    server.sendall(notification(b'a', b'1') + notification(b'b', b'2'))
+    assert ['a', 'b'] == [n['channel'] for n in c.wait_notify()]
+
+    c._socket.close()
+    server.close()
@@ -55,3 +55,12 @@ def test_pickle_dotdict():
     orig = DotDict(dict(a=1, b=dict(c=2)))
     copy = unpickle(pickle(orig))
     assert 2 == copy.b.c
+
+
+def test_json_array():
+    import json
+    from temboardagent.utils import JSONArray
+
+    assert [] == json.loads(JSONArray().dumps())
+    my = JSONArray(['{"a": 1}', '2', '"three"'])
+    assert [{'a': 1}, 2, 'three'] == json.loads(my.dumps())
@@ -90,3 +90,13 @@ def test_port():
 
     with pytest.raises(ValueError):
         v.port('pouet')
+
+
+def test_timeout():
+    assert 10 == v.timeout('10')
+
+    with pytest.raises(ValueError):
+        v.timeout('0')
+
+    with pytest.raises(ValueError):
+        v.timeout('pouet')